@@ -21,7 +21,7 @@ def main():
     
     import subprocess
     subprocess.call(['python', 'scripts/copyProperIntrinsicAndInitExtrinsicsBySomething.py', paramsFromBlenderFilename, initialParamsFilename]);
-    subprocess.call(['python', 'Calibrator/calibrateCameras.py', '-ncams', f'{num_of_cams}', '-camrange', f'{cameraRange}', '-npoints', f'{numFrames}', '-r', markerPosFilename, '-i', initialParamsFilename, '-o', estimatedParamsFilename]);
+    subprocess.call(['python', 'Calibrator/calibrateCameras.py', '-ncams', f'{num_of_cams}', '-camrange', f'{cameraRange}', '-npoints', f'{numFrames}', '-r', markerPosFilename, '-i', initialParamsFilename, '-o', estimatedParamsFilename, '-cache', '3_calibration/cache']);
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,201 @@
+import os
+import sys
+import time
+import json
+import importlib
+import queue
+import argparse
+import contextlib
+import traceback
+import multiprocessing as mp
+from concurrent import futures
+
+import calibrateCameras
+import utils
+
+# ===================================================================================================
+# Manifest of calibration jobs
+# ===================================================================================================
+# JSON file with options shared by all jobs and a list of jobs, each given by the required arguments of
+# calibrateCameras.py and optionally its own name and options, e.g.
+# {"options": ["-cache", "cache"],
+#  "jobs": [{"name": "session1", "ncams": 20, "npoints": 667, "camrange": "0:1:19",
+#            "r": "session1/markerPositions.txt", "i": "session1/initialParams.json", "o": "session1/params.json",
+#            "options": ["-pairs", "nearest"]}]}
+# Relative paths are relative to the manifest, also those of path options.
+_JOB_PATHS = ['r', 'i', 'o']
+_OPTION_PATHS = ['-pairlist', '-trace', '--trace', '-cache', '--cache']
+
+def _resolveOptionPaths(options, directory):
+    # Options with values of path options (given as -option value or -option=value) joined with the directory
+    resolved = []
+    for n, option in enumerate(options):
+        name, separator, value = option.partition('=')
+        if separator and name in _OPTION_PATHS:
+            option = name + '=' + os.path.join(directory, value)
+        elif n > 0 and options[n - 1] in _OPTION_PATHS:
+            option = os.path.join(directory, option)
+        resolved.append(option)
+    return resolved
+
+def readManifest(path):
+    # List of (name, calibrateCameras.py argv) of the jobs of a manifest
+    with open(path) as f:
+        manifest = json.load(f)
+    directory = os.path.dirname(os.path.abspath(path))
+
+    jobs = []
+    for n, job in enumerate(manifest['jobs']):
+        missing = [name for name in ['ncams', 'npoints', 'camrange'] + _JOB_PATHS if name not in job]
+        if len(missing) > 0:
+            raise ValueError(f'{path}: job {n} misses ' + ', '.join(missing))
+        paths = {name: os.path.join(directory, job[name]) for name in _JOB_PATHS}
+        argv = ['-ncams', str(job['ncams']), '-camrange', str(job['camrange']), '-npoints', str(job['npoints']), \
+            '-r', paths['r'], '-i', paths['i'], '-o', paths['o']]
+        argv += _resolveOptionPaths([str(option) for option in manifest.get('options', []) + job.get('options', [])], directory)
+        name = job.get('name', os.path.splitext(os.path.basename(job['o']))[0])
+        jobs.append((name, argv))
+    return jobs
+
+# ===================================================================================================
+# Workers
+# ===================================================================================================
+_worker = {}
+
+def _initJobWorker(events):
+    # Imports, SciPy and compiled kernels are loaded once per worker process and shared by all of its jobs
+    start = time.perf_counter()
+    for module in ['scipy.optimize', 'scipy.sparse', 'calibrator']:
+        importlib.import_module(module)
+    utils.warmupKernels()
+    _worker['events'] = events
+    events.put(('warmup', os.getpid(), time.perf_counter() - start))
+
+@contextlib.contextmanager
+def _redirectOutput(path):
+    # Output of a job (also of SciPy solvers writing to the file descriptors directly) goes to its log file
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(path, 'w') as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            for fd in saved: os.close(fd)
+
+def _runJob(task):
+    jobId, name, args = task
+    _worker['events'].put(('started', jobId, os.getpid()))
+    logPath = os.path.splitext(args.o)[0] + '.log'
+    result = {'name': name, 'log': logPath, 'error': None, 'cached': False, 'files': []}
+    start = time.perf_counter()
+    with _redirectOutput(logPath):
+        try:
+            result['status'] = 'done' if calibrateCameras.calibrateCameras(args, result) else 'failed'
+            result['message'] = ''
+        except Exception as error:
+            traceback.print_exc()
+            result['status'], result['message'] = 'failed', f'{type(error).__name__}: {error}'
+    if result['status'] == 'done' and result['cached']: result['status'] = 'cached'
+    result['seconds'] = time.perf_counter() - start
+    return jobId, result
+
+# ===================================================================================================
+# Batch
+# ===================================================================================================
+def _printStatus(jobId, numOfJobs, name, message):
+    print(f'[{jobId+1}/{numOfJobs}] {name}: {message}', flush=True)
+
+def _formatSummary(results):
+    # Tab-separated table of the jobs in manifest order
+    lines = ['job\tstatus\tfinal error\tseconds\toutput']
+    for result in results:
+        error = '' if result['error'] is None else f'{result["error"]:.6f}'
+        lines.append(f'{result["name"]}\t{result["status"]}\t{error}\t{result["seconds"]:.2f}\t{result["output"]}')
+    return '\n'.join(lines) + '\n'
+
+def runBatch(args) -> bool:
+    # Runs the jobs of the manifest on a process pool and writes the summary table, succeeds if all jobs do
+    jobs = readManifest(args.manifest)
+    numOfJobs = len(jobs)
+    numOfProcesses = min(max(numOfJobs, 1), args.jobs if args.jobs > 0 else mp.cpu_count())
+    numOfThreads = max(1, mp.cpu_count() // numOfProcesses)
+
+    # Jobs are validated before any of them starts, each one gets its share of cores unless it sets -threads
+    tasks, results = [], [None] * numOfJobs
+    for jobId, (name, argv) in enumerate(jobs):
+        if '-threads' not in argv and '--threads' not in argv: argv = argv + ['-threads', str(numOfThreads)]
+        try:
+            with contextlib.redirect_stderr(sys.stdout):
+                jobArgs = calibrateCameras.parseArgs(argv)
+        except SystemExit:
+            results[jobId] = {'name': name, 'status': 'invalid', 'error': None, 'seconds': 0.0, 'output': '', 'message': 'invalid options'}
+            _printStatus(jobId, numOfJobs, name, 'invalid options, skipped')
+            continue
+        tasks.append((jobId, name, jobArgs))
+        results[jobId] = {'name': name, 'status': 'pending', 'error': None, 'seconds': 0.0, 'output': jobArgs.o, 'message': ''}
+
+    print(f'Running {len(tasks)} of {numOfJobs} jobs on {numOfProcesses} processes with {numOfThreads} threads each.', flush=True)
+    start = time.perf_counter()
+    ctx = mp.get_context('spawn')
+    events = ctx.Queue()
+    # Worker processes are not daemonic, so jobs may start their own pools (-workers, -starts, -clustersize)
+    with futures.ProcessPoolExecutor(numOfProcesses, mp_context=ctx, initializer=_initJobWorker, initargs=(events,)) as executor:
+        pending = {executor.submit(_runJob, task): task for task in tasks}
+        while len(pending) > 0 or not events.empty():
+            done, _ = futures.wait(pending, timeout=0.2, return_when=futures.FIRST_COMPLETED)
+            try:
+                while True:
+                    event = events.get_nowait()
+                    if event[0] == 'warmup':
+                        print(f'Worker {event[1]} warmed up in {event[2]:.2f} s', flush=True)
+                    else:
+                        _printStatus(event[1], numOfJobs, results[event[1]]['name'], f'started (worker {event[2]})')
+            except queue.Empty:
+                pass
+
+            for future in done:
+                jobId, name, _ = pending.pop(future)
+                try:
+                    _, result = future.result()
+                except Exception as error:
+                    result = {'status': 'failed', 'error': None, 'seconds': 0.0, 'message': f'{type(error).__name__}: {error}'}
+                results[jobId].update(result)
+                result = results[jobId]
+                message = f'{result["status"]} in {result["seconds"]:.2f} s'
+                if result['error'] is not None: message += f', final error {result["error"]:.6f}'
+                if result['message']: message += f', {result["message"]}'
+                if 'log' in result: message += f' (log {result["log"]})'
+                _printStatus(jobId, numOfJobs, name, message)
+
+    summary = _formatSummary(results)
+    summaryPath = args.summary if args.summary is not None else os.path.splitext(args.manifest)[0] + '_summary.txt'
+    with open(summaryPath, 'w') as f:
+        f.write(summary)
+
+    failed = sum(result['status'] in ['failed', 'invalid'] for result in results)
+    print('===========================================================================')
+    rows = [line.split('\t') for line in summary.splitlines()]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
+    print(f'{numOfJobs - failed} of {numOfJobs} jobs succeeded in {time.perf_counter() - start:.2f} s')
+    print(f'Saving summary to {summaryPath}.')
+    print('===========================================================================\n')
+    return failed == 0
+
+def parseArgs(argv=None):
+    argParser = argparse.ArgumentParser(prog="calibrateCameras.py batch", description="Runs the calibrations of a manifest on a process pool")
+    argParser.add_argument('-manifest', '--manifest', type=str, required=True, help="JSON file with the jobs (see batch.py) and options shared by them")
+    argParser.add_argument('-jobs', '--jobs', type=int, default=0,    help="Number of jobs run concurrently (0 uses all cores)")
+    argParser.add_argument('-summary', '--summary', type=str, default=None, help="Tab-separated summary table of final errors and timings, <manifest>_summary.txt by default")
+    return argParser.parse_args(argv)
+
+if __name__ == '__main__':
+    sys.exit(0 if runBatch(parseArgs()) else 1)
@@ -0,0 +1,234 @@
+import os
+import io
+import sys
+import time
+import json
+import shutil
+import platform
+import tempfile
+import contextlib
+import multiprocessing as mp
+import numpy as np
+
+from scipy.spatial.transform import Rotation
+
+import calibrateCameras
+import calibrator
+import markers
+import utils
+
+# ===================================================================================================
+# Synthetic rig
+# ===================================================================================================
+def writeSyntheticRig(directory, numOfCams, numOfPoints, seed=0, noise=0.5, outliers=0.02, perturbation=0.02):
+    # Ring of cameras looking at a marker moving inside a unit cube, written as reference points file and
+    # initial params (true poses perturbed by given std dev). Returns the paths and the true params.
+    rng = np.random.default_rng(seed)
+    focal, resolution = 1866.6666259765625, np.array([1920, 1080])
+    K = np.array([[focal, 0, resolution[0]/2], [0, focal, resolution[1]/2], [0, 0, 1]])
+
+    angles = 2 * np.pi * np.arange(numOfCams) / numOfCams
+    positions = np.stack([5 * np.cos(angles), 0.3 * rng.standard_normal(numOfCams), 5 * np.sin(angles)], axis=1)
+    axesZ = -positions / np.linalg.norm(positions, axis=1)[:, None]
+    axesX = np.cross([0, 1, 0], axesZ)
+    axesX /= np.linalg.norm(axesX, axis=1)[:, None]
+    rotationMs = np.stack([axesX, np.cross(axesZ, axesX), axesZ], axis=1)
+
+    trajectory = np.cumsum(rng.normal(0, 0.05, (numOfPoints, 3)), axis=0)
+    trajectory = 2 * (trajectory - trajectory.min(axis=0)) / np.maximum(np.ptp(trajectory, axis=0), 1e-9) - 1
+
+    points = np.zeros((numOfPoints, numOfCams * 3))
+    for cam in range(numOfCams):
+        proj = (trajectory - positions[cam]) @ rotationMs[cam].T @ K.T
+        xy = proj[:, 0:2] / proj[:, 2:3] + rng.normal(0, noise, (numOfPoints, 2))
+        wrong = rng.random(numOfPoints) < outliers
+        xy[wrong] = rng.uniform(0, resolution, (wrong.sum(), 2))
+        visible = (proj[:, 2] > 0) & np.all((xy > 0) & (xy < resolution), axis=1) & (rng.random(numOfPoints) > 0.2)
+        points[:, 3*cam:3*cam+3] = np.where(visible[:, None], np.concatenate([xy, np.ones((numOfPoints, 1))], axis=1), [-1, -1, 0])
+
+    trueParam = np.concatenate([Rotation.from_matrix(rotationMs).as_quat(), positions], axis=1)
+    initRotationVs = (Rotation.from_rotvec(rng.normal(0, perturbation, (numOfCams, 3))) * Rotation.from_matrix(rotationMs)).as_euler('xyz', degrees=True)
+    initPositions = positions + rng.normal(0, perturbation, (numOfCams, 3))
+    cameras = [{'Name': f'v{cam}', 'Position': initPositions[cam].tolist(), 'Rotation': initRotationVs[cam].tolist(), \
+        'Resolution': resolution.tolist(), 'Projection': 'Perspective', 'Focal': [focal, focal], \
+        'Principle_point': (resolution/2).tolist(), 'Depth_range': [0.5, 50]} for cam in range(numOfCams)]
+
+    referencePointsPath = os.path.join(directory, 'markerPositions.txt')
+    initCamParamsPath = os.path.join(directory, 'initialParams.json')
+    markers.writeMarkerPositions(referencePointsPath, *markers.markerArraysFromRows(points, numOfCams))
+    with open(initCamParamsPath, 'w') as f:
+        json.dump({'cameras': cameras}, f, indent=2)
+    return referencePointsPath, initCamParamsPath, trueParam.flatten()
+
+def syntheticArgs(directory, numOfCams, numOfPoints, options=[], seed=0):
+    # Command line args of calibrateCameras.py for a synthetic rig written to directory
+    referencePointsPath, initCamParamsPath, _ = writeSyntheticRig(directory, numOfCams, numOfPoints, seed)
+    return calibrateCameras.parseArgs(['-ncams', str(numOfCams), '-camrange', f'0:1:{numOfCams-1}', '-npoints', str(numOfPoints), \
+        '-r', referencePointsPath, '-i', initCamParamsPath, '-o', os.path.join(directory, 'calibratedParams.json')] + list(options))
+
+# ===================================================================================================
+# Objective microbenchmark
+# ===================================================================================================
+def _projectionMatricesPerCamera(K, optimParam):
+    # Reference: projection matrices built camera by camera with Rotation objects
+    P = np.full((len(K),4,4), np.zeros(4))
+    for i in range(len(K)):
+        E = np.eye(4)
+        E[0:3,0:3] = Rotation.from_quat(optimParam[7*i:7*i+4]).as_matrix()
+        E[0:3,3] = -1 * np.matmul(E[0:3,0:3], optimParam[7*i+4:7*i+7])
+        P[i] = np.matmul(K[i], E)
+    return P
+
+def _evaluationsPerSecond(function, evaluations):
+    function()
+    start = time.perf_counter()
+    for _ in range(evaluations): function()
+    return evaluations / (time.perf_counter() - start)
+
+def _unmemoized(app, function):
+    # Repeated evaluations at the same params would be served from the memo of the Calibrator
+    def evaluate():
+        app._memo.clear()
+        return function()
+    return evaluate
+
+def measureEvaluations(app, evaluations=50):
+    # Evaluations per second of the projection matrices and the objective (with gradient) of a Calibrator
+    optimParam = np.array(app._optimParam, dtype=np.float64)
+    return {
+        'projections per camera':   _evaluationsPerSecond(lambda: _projectionMatricesPerCamera(app.K, optimParam), evaluations),
+        'projections batched':      _evaluationsPerSecond(lambda: app._projectionMatrices(optimParam), evaluations),
+        'objective':                _evaluationsPerSecond(_unmemoized(app, lambda: app._minFunctionExtrinsic(optimParam)), evaluations),
+        'objective and gradient':   _evaluationsPerSecond(_unmemoized(app, lambda: app._minFunctionExtrinsicDers(optimParam)), evaluations),
+        'memoized':                 _evaluationsPerSecond(lambda: app._minFunctionExtrinsicDers(optimParam), evaluations)}
+
+# ===================================================================================================
+# Benchmark harness
+# ===================================================================================================
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'samples', 'calibration')
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'benchmark_baseline.json')
+
+# Metrics compared against the baseline: (higher is better, absolute change below which it is not a regression)
+METRICS = {'evaluations per second': (True, 0.0), 'rejection time': (False, 0.01), 'run time': (False, 0.1), \
+           'peak RSS [MB]': (False, 10.0), 'final error': (False, 0.001)}
+
+def sampleArgs(directory, options=[]):
+    # Command line args of calibrateCameras.py for a copy of samples/calibration, the sample params miss the depth
+    # range, so the one of globalSetup.py is added
+    shutil.copy(os.path.join(SAMPLE_DIR, 'markerPositions.txt'), directory)
+    with open(os.path.join(SAMPLE_DIR, 'initialParams.json')) as f:
+        initialParams = json.load(f)
+    for camera in initialParams['cameras']: camera.setdefault('Depth_range', [10, 200])
+    with open(os.path.join(directory, 'initialParams.json'), 'w') as f:
+        json.dump(initialParams, f, indent=2)
+    return calibrateCameras.parseArgs(['-ncams', '20', '-camrange', '0:1:19', '-npoints', '667', \
+        '-r', os.path.join(directory, 'markerPositions.txt'), '-i', os.path.join(directory, 'initialParams.json'), \
+        '-o', os.path.join(directory, 'calibratedParams.json')] + list(options))
+
+def _peakRSS():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def _runCase(task):
+    # One benchmark case in a fresh process, so that the peak RSS belongs to this case only
+    name, numOfCams, numOfPoints, options, evaluations, iterations = task
+    with tempfile.TemporaryDirectory() as directory:
+        makeArgs = (lambda: sampleArgs(directory, options)) if name == 'sample' else (lambda: syntheticArgs(directory, numOfCams, numOfPoints, options))
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = calibrator.Calibrator(makeArgs())
+            evalsPerSec = measureEvaluations(app, evaluations)['objective and gradient']
+            app._minFunctionExtrinsic(np.array(app._optimParam))
+            start = time.perf_counter()
+            app._rejectReferencePoints()
+            rejectionTime = time.perf_counter() - start
+            app.close()
+
+            app = calibrator.Calibrator(makeArgs())
+            start = time.perf_counter()
+            app.run(iterations=iterations)
+            runTime = time.perf_counter() - start
+            app.close()
+
+    return name, {'cameras': app._numOfCamerasToCalibrate, 'points': app._numberOfReferencePoints, \
+        'evaluations per second': evalsPerSec, 'rejection time': rejectionTime, 'run time': runTime, \
+        'peak RSS [MB]': _peakRSS(), 'final error': app._error}
+
+def runBenchmarks(sizes, sample=True, options=[], evaluations=20, iterations=2):
+    # Runs the sample and synthetic cases (cameras, points) one after another, each in a new process
+    tasks = [('sample', 20, 667, options, evaluations, iterations)] if sample else []
+    tasks += [(f'synthetic {numOfCams}x{numOfPoints}', numOfCams, numOfPoints, options, evaluations, iterations) for numOfCams, numOfPoints in sizes]
+
+    results = {'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'numba': utils.NUMBA_AVAILABLE, \
+        'cpu count': mp.cpu_count(), 'options': list(options)}, 'cases': {}}
+    ctx = mp.get_context('spawn')
+    for task in tasks:
+        with ctx.Pool(1) as pool:
+            name, caseResults = pool.apply(_runCase, (task,))
+        results['cases'][name] = caseResults
+        print(f'{name}: ' + ', '.join(f'{metric} {caseResults[metric]:.4g}' for metric in METRICS if caseResults[metric] is not None))
+    return results
+
+def compareWithBaseline(results, baseline, threshold):
+    # Prints the relative change of every metric and returns the list of (case, metric) regressions above threshold
+    regressions = []
+    print('===========================================================================')
+    print(f'{"case":24s} {"metric":24s} {"baseline":>12s} {"current":>12s} {"change":>8s}')
+    for name, caseResults in results['cases'].items():
+        if name not in baseline['cases']: continue
+        for metric, (higherIsBetter, tolerance) in METRICS.items():
+            current, reference = caseResults.get(metric), baseline['cases'][name].get(metric)
+            if current is None or reference is None or reference == 0: continue
+            change = current / reference - 1
+            regressed = (-change if higherIsBetter else change) > threshold and abs(current - reference) > tolerance
+            if regressed: regressions.append((name, metric))
+            print(f'{name:24s} {metric:24s} {reference:12.4g} {current:12.4g} {100*change:+7.1f}%' + (' REGRESSION' if regressed else ''))
+    print('===========================================================================\n')
+    return regressions
+
+if __name__ == '__main__':
+    import argparse
+    argParser = argparse.ArgumentParser(prog="benchmark.py", description="Calibrator benchmarks on the sample and synthetic rigs")
+    argParser.add_argument('-sizes',        type=str, nargs='*', default=['20x2000'], help="Synthetic rig sizes, <cameras>x<points>")
+    argParser.add_argument('-nosample',     action='store_true', help="Skip samples/calibration")
+    argParser.add_argument('-evaluations',  type=int, default=20,   help="Number of timed objective and gradient evaluations")
+    argParser.add_argument('-iterations',   type=int, default=2,    help="Global iterations of the timed run()")
+    argParser.add_argument('-options',      type=str, default='',   help="Extra calibrateCameras.py options, e.g. \"-backend numpy\"")
+    argParser.add_argument('-o',            type=str, default='benchmark_results.json', help="Output JSON file with results")
+    argParser.add_argument('-baseline',     type=str, default=BASELINE_PATH, help="Baseline JSON file results are compared with")
+    argParser.add_argument('-threshold',    type=float, default=0.2, help="Relative change of a metric reported as regression")
+    argParser.add_argument('-updatebaseline', action='store_true', help="Store the results as the new baseline")
+    argParser.add_argument('-micro',        action='store_true', help="Only print evaluations per second of the objective parts on the first synthetic size")
+    args = argParser.parse_args()
+    sizes = [tuple(int(n) for n in size.split('x')) for size in args.sizes]
+
+    if args.micro:
+        with tempfile.TemporaryDirectory() as directory:
+            app = calibrator.Calibrator(syntheticArgs(directory, sizes[0][0], sizes[0][1], args.options.split()))
+            microResults = measureEvaluations(app, args.evaluations)
+            app.close()
+        print(f'{sizes[0][0]} cameras, {sizes[0][1]} points')
+        for name, evalsPerSec in microResults.items():
+            print(f'{name:24s}: {evalsPerSec:10.1f} evaluations/s')
+        sys.exit(0)
+
+    results = runBenchmarks(sizes, not args.nosample, args.options.split(), args.evaluations, args.iterations)
+    with open(args.o, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saving results to {args.o}.')
+
+    if args.updatebaseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saving baseline to {args.baseline}.')
+        sys.exit(0)
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline {args.baseline}, run with -updatebaseline to create it.')
+        sys.exit(0)
+    with open(args.baseline) as f:
+        regressions = compareWithBaseline(results, json.load(f), args.threshold)
+    sys.exit(1 if regressions else 0)
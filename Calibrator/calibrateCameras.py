@@ -2,26 +2,95 @@ import platform
 import sys
 import os
 import argparse
+import subprocess
 
 import calibrator
+import markers
 import parameters
+import resultcache
+import utils
 
-def calibrateCameras(args:list) -> bool:
+# Options that don't change the calibration result, input files are hashed by content instead of their paths.
+# Results don't depend on the number of threads or worker processes evaluating the camera pairs either.
+_UNCACHED_OPTIONS = ['r', 'i', 'o', 'pairlist', 'trace', 'resume', 'checkpointinterval', 'checkgrad', 'cache', 'cachesize', \
+    'threads', 'workers']
 
-    app = calibrator.Calibrator(args)
-    app.run(iterations=2)
+def calibrateCameras(args:list, result:dict=None) -> bool:
+    # Identical inputs and options restore the outputs of a previous run from the cache (not for time-budgeted,
+    # resumed or gradient-check runs). The optional result dict receives the final error and the output files.
+    cache = None
+    if args.cache is not None and args.timebudget is None and not args.resume and args.checkgrad is None:
+        cache = resultcache.ResultCache(args.cache, int(args.cachesize * 2**20))
+        options = {name: value for name, value in vars(args).items() if name not in _UNCACHED_OPTIONS}
+        options['iterations'] = 2
+        key = resultcache.calcCacheKey([args.r, args.i, args.pairlist], options)
+        restored = cache.restore(key, args.o)
+        if restored is not None:
+            restoredFiles, error = restored
+            print(f'Calibration found in cache {args.cache} ({key[:16]}), restored ' + ', '.join(restoredFiles))
+            if result is not None: result.update(error=error, cached=True, files=restoredFiles)
+            return True
+
+    if args.checkgrad is not None:
+        app = calibrator.Calibrator(args)
+        try:
+            return app.checkGradient(perturbation=args.checkgrad)
+        finally:
+            app.close()
+
+    # Files are read here, the calibration itself runs on arrays and params in memory
+    XY, visibility = markers.readMarkerPositions(args.r, args.ncams)
+    if XY.shape[1] != args.npoints:
+        raise ValueError(f'{args.r}: {XY.shape[1]} reference points, expected {args.npoints}')
+    cameraIds = calibrator.parseCameraRange(args.camrange)
+    cameraParameters = parameters.SystemParameters(cameraIds)
+    cameraParameters.readFrom(args.i)
+
+    options = {name: getattr(args, name) for name in calibrator.DEFAULT_OPTIONS}
+    calibration = calibrator.calibrate(XY, visibility, cameraParameters, cameraIds, iterations=2, outputPath=args.o, **options)
+    if cache is not None:
+        # The calibration succeeded even if its outputs cannot be cached
+        try:
+            cache.store(key, args.o, calibration.outputFiles, calibration.error)
+        except OSError as error:
+            print(f'Warning: calibration not stored in cache {args.cache}: {error}')
+    if result is not None: result.update(error=calibration.error, cached=False, files=calibration.outputFiles)
     return True
 
-if __name__ == '__main__':
-    print("PythonVer  = " + str(platform.python_version() ))
-    print("PythonExe  = " + str(sys.executable            ))
-    print("WorkingDir = " + str(os.getcwd()               ))
-    print("ScriptPath = " + str(os.path.realpath(__file__)))
-    print("\n")
-    print("ARGC={} ARGV={}\n".format(len(sys.argv), str(sys.argv)))
+def warmup() -> bool:
+    # Fill the on-disk cache of compiled kernels and report where start-up time goes
+    reportImportTimes()
+
+    print('===========================================================================')
+    print('Compiled kernels')
+    if not utils.NUMBA_AVAILABLE: print('numba is not installed, kernels run as plain Python/NumPy')
+    for name, (seconds, cached) in utils.warmupKernels().items():
+        print(f'{name:40s} {seconds:8.3f} s' + (' (from cache)' if cached else ' (compiled and cached)'))
+    print('===========================================================================\n')
+    return True
+
+def reportImportTimes(module='calibrator', top=10) -> bool:
+    # Import times per top-level package of a fresh interpreter importing the given module (python -X importtime)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], \
+        cwd=os.path.dirname(os.path.realpath(__file__)), capture_output=True, text=True)
 
+    packageTimes = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line: continue
+        selfTime, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packageTimes[package] = packageTimes.get(package, 0) + int(selfTime)
+
+    print('===========================================================================')
+    print(f'Import time of {module}: {sum(packageTimes.values())/1e6:.3f} s')
+    for package, packageTime in sorted(packageTimes.items(), key=lambda item: -item[1])[:top]:
+        print(f'{package:40s} {packageTime/1e6:8.3f} s')
+    print('===========================================================================\n')
+    return result.returncode == 0
+
+def parseArgs(argv=None):
     # Processing commandline
-    argParser = argparse.ArgumentParser(prog="calibrateCameras.py")
+    argParser = argparse.ArgumentParser(prog="calibrateCameras.py", epilog="Run 'calibrateCameras.py warmup' once to compile and cache kernels, 'calibrateCameras.py batch -manifest <json>' to run many calibrations")
     requiredArgs = argParser.add_argument_group('required arguments')
     requiredArgs.add_argument("-ncams",     type=int, required=True, help="Number of all cameras")
     requiredArgs.add_argument('-camrange',  type=str, required=True, help="Cameras to calibrate, <start:step:stop> or <[0,1,2,...]>")
@@ -29,11 +98,62 @@ if __name__ == '__main__':
     requiredArgs.add_argument('-r',         type=str, required=True, help="Path to txt file with reference points")
     requiredArgs.add_argument('-i',         type=str, required=True, help='Initial parameters file (json)')
     requiredArgs.add_argument('-o',         type=str, required=True, help="Path to output txt file with calibrated params")
+    argParser.add_argument('-solver', '--solver', type=str, choices=['lbfgsb', 'least_squares'], help="L-BFGS-B on the mean error or sparse least squares on per-point residuals")
+    argParser.add_argument('-lsjac',        type=str, choices=['analytic', '2-point'], help="Jacobian of the least_squares solver (2-point uses its sparsity pattern)")
+    argParser.add_argument('-backend',      type=str, choices=utils.EPIPOLAR_BACKENDS, help="Backend of the epipolar error kernel (auto selects numba if installed), threads runs blocks of pairs on a thread pool")
+    argParser.add_argument('-threads', '--threads', type=int, help="Threads of the numba and threads backends evaluating camera pairs within the process (0 uses all cores)")
+    argParser.add_argument('-workers',      type=int, help="Number of worker processes evaluating camera pairs of the objective")
+    argParser.add_argument('-loss',         type=str, choices=utils.ROBUST_LOSSES, help="Robust loss applied to point distances in the objective")
+    argParser.add_argument('-lossscale',    type=float, help="Scale of the robust loss (in pixels), distances above it are down-weighted")
+    argParser.add_argument('-starts',       type=int, help="Number of (perturbed) initial params optimized concurrently, the best solution is kept")
+    argParser.add_argument('-startnoise',   type=float, help="Std dev of the perturbation of initial params for multi-start")
+    argParser.add_argument('-pairs', '--pairs', type=str, choices=utils.PAIR_POLICIES, help="Camera pairs evaluated by the objective: all, co-visible, nearest by initial pose or an explicit list")
+    argParser.add_argument('-pairminpoints', type=int, help="Minimum number of co-visible points of a pair (pairs covisible)")
+    argParser.add_argument('-pairnearest',  type=int, help="Number of nearest cameras paired with every camera (pairs nearest)")
+    argParser.add_argument('-pairlist',     type=str, help="Text file with camera id pairs, one pair per line (pairs list)")
+    argParser.add_argument('-clustersize',  type=int, help="Calibrate overlapping clusters of this many co-visible cameras in parallel and merge them before the global iterations (0 disables)")
+    argParser.add_argument('-clusteroverlap', type=int, help="Number of cameras shared by consecutive clusters, used to align them")
+    argParser.add_argument('-subsample', '--subsample', type=float, nargs='+', help="Fractions of reference points solved coarse-to-fine before the full set, e.g. 0.05 0.2")
+    argParser.add_argument('-objective', '--objective', type=str, choices=['epipolar', 'reprojection'], help="Mean epipolar distance over camera pairs or mean reprojection error of triangulated points over cameras")
+    argParser.add_argument('-trajectory',   action='store_true',     help="Save triangulated reference points with the params of every global iteration")
+    argParser.add_argument('-trace', '--trace', type=str, help="JSONL file recording every objective evaluation, rejection and global iteration")
+    argParser.add_argument('-resume', '--resume', action='store_true', help="Continue from the checkpoint saved next to the output params after every global iteration")
+    argParser.add_argument('-checkpointinterval', '--checkpoint-interval', dest='checkpointinterval', type=float, help="Seconds between checkpoints of the best params of an unfinished solve (L-BFGS-B), 0 checkpoints only global iterations")
+    argParser.add_argument('-chunkpoints', '--chunk-points', dest='chunkpoints', type=int, help="Evaluate the objective on chunks of this many reference points to bound memory, e.g. with a binary marker store (0 disables)")
+    argParser.add_argument('-timebudget', '--time-budget', dest='timebudget', type=float, help="Anytime mode: stop after this many seconds and save the best params so far")
+    argParser.add_argument('-targeterror', '--target-error', dest='targeterror', type=float, help="Anytime mode: stop once the mean error reaches this value")
+    argParser.add_argument('-plateau',      type=float, help="Anytime mode: stop a solve when the best error improves relatively by less than this over the plateau window")
+    argParser.add_argument('-plateauwindow', type=int, help="Anytime mode: number of objective evaluations of the plateau window")
+    argParser.add_argument('-cache', '--cache', type=str, default=None, help="Directory caching outputs of calibrations by a hash of input files and options, identical runs restore them")
+    argParser.add_argument('-cachesize',    type=float, default=1024,  help="Maximum size of the cache in MB, least recently used results are evicted")
+    argParser.add_argument('-checkgrad',    type=float, nargs='?', const=0.0, help="Only compare the analytic gradient with finite differences at the initial params, optionally perturbed by given std dev")
+
+    # Defaults of calibration options are shared with the in-process API (calibrator.calibrate)
+    argParser.set_defaults(**calibrator.DEFAULT_OPTIONS)
+
+    args = argParser.parse_args(argv)
+    try:
+        calibrator.checkOptions(vars(args))
+    except ValueError as error:
+        argParser.error(str(error))
+    return args
+
+if __name__ == '__main__':
+    print("PythonVer  = " + str(platform.python_version() ))
+    print("PythonExe  = " + str(sys.executable            ))
+    print("WorkingDir = " + str(os.getcwd()               ))
+    print("ScriptPath = " + str(os.path.realpath(__file__)))
+    print("\n")
+    print("ARGC={} ARGV={}\n".format(len(sys.argv), str(sys.argv)))
 
-    args = argParser.parse_args()
-  
     # processing
-    result = calibrateCameras(args)
+    if len(sys.argv) > 1 and sys.argv[1] == 'warmup':
+        result = warmup()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        import batch
+        result = batch.runBatch(batch.parseArgs(sys.argv[2:]))
+    else:
+        result = calibrateCameras(parseArgs())
 
     if(not result):
         print("Exiting with EXIT_FAILURE", file=sys.stdout)
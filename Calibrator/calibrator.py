@@ -1,46 +1,162 @@
 
 import os
+import copy
+import time
+import argparse
+import collections
 import numpy as np
-import multiprocessing as mp
-
-from scipy import optimize
-from scipy.spatial.transform import Rotation
 
+import instrumentation
+import markers
 import parameters
+import parallel
+import resultcache
 import utils
+import workspace
+
+# Options of a calibration besides its inputs and outputs, the command line options of calibrateCameras.py
+DEFAULT_OPTIONS = {
+    'backend': 'auto', 'threads': 0, 'solver': 'lbfgsb', 'lsjac': 'analytic', 'workers': 1, 'loss': 'none', 'lossscale': 1.0,
+    'starts': 1, 'startnoise': 0.1, 'pairs': 'all', 'pairminpoints': 1, 'pairnearest': 4, 'pairlist': None,
+    'clustersize': 0, 'clusteroverlap': 3, 'subsample': None, 'objective': 'epipolar', 'trajectory': False, 'trace': None,
+    'resume': False, 'checkpointinterval': 60.0, 'chunkpoints': 0, 'timebudget': None, 'targeterror': None, 'plateau': 1e-6, 'plateauwindow': 100}
+
+# Options a calibration may be resumed with other values of: evaluation resources, outputs and stop criteria
+# of anytime mode. Pairs from -pairlist are part of the checkpoint key themselves.
+_RESUMABLE_OPTIONS = ['threads', 'workers', 'pairlist', 'trajectory', 'trace', 'resume', 'checkpointinterval', \
+    'timebudget', 'targeterror', 'plateau', 'plateauwindow']
+
+def checkOptions(options):
+    # Raises ValueError for combinations of options that are not supported
+    if options['pairs'] == 'list' and options['pairlist'] is None: raise ValueError("-pairs list requires -pairlist")
+    if options['objective'] == 'reprojection' and options['solver'] == 'least_squares': raise ValueError("-objective reprojection requires -solver lbfgsb")
+    if options['objective'] == 'reprojection' and options['workers'] > 1: raise ValueError("-objective reprojection requires a single worker")
+    if options['solver'] == 'least_squares' and options['starts'] > 1: raise ValueError("-solver least_squares requires a single start")
+    if options['chunkpoints'] > 0 and (options['solver'] != 'lbfgsb' or options['objective'] != 'epipolar' or options['workers'] > 1 or options['starts'] > 1):
+        raise ValueError("-chunkpoints requires -solver lbfgsb, -objective epipolar, a single worker and a single start")
+    if (options['timebudget'] is not None or options['targeterror'] is not None) and options['solver'] != 'lbfgsb':
+        raise ValueError("-timebudget and -targeterror require -solver lbfgsb")
+    # Consecutive clusters are aligned by a similarity transform of their shared cameras, which needs two camera centres
+    if options['clustersize'] > 0 and not 2 <= options['clusteroverlap'] < options['clustersize']:
+        raise ValueError("-clustersize requires -clusteroverlap of at least 2 and below the cluster size")
+    return True
+
+def parseCameraRange(camrange):
+    # Ids of cameras given as <start:step:stop>, <[0,1,2,...]> or a sequence of ids
+    if not isinstance(camrange, str):
+        return list(map(int, camrange))
+    if camrange[0] == '[' and camrange[-1] == ']':
+        return list(map(int, camrange[1:-1].split(',')))
+    start, step, stop = tuple(camrange.split(":"))
+    return np.arange(int(start), int(stop)+1, int(step))
+
+CalibrationResult = collections.namedtuple('CalibrationResult', ['parameters', 'error', 'outputFiles'])
+
+def calibrate(XY, visibility, cameraParameters, cameraIds=None, iterations=2, outputPath=None, traceCallback=None, **options):
+    # In-process calibration from marker coordinates (N,P,2) and visibility flags (N,P) of all N cameras (see markers.py)
+    # and initial SystemParameters, of the given cameras or all cameras of cameraParameters. Options are those of
+    # DEFAULT_OPTIONS. Params of every global iteration are written next to outputPath only if it is given.
+    # Returns the solved SystemParameters (a copy, cameraParameters stay unchanged), the final error and the output files.
+    unknown = [name for name in options if name not in DEFAULT_OPTIONS]
+    if len(unknown) > 0: raise TypeError('Unknown calibration options: ' + ', '.join(unknown))
+    options = dict(DEFAULT_OPTIONS, **options)
+    checkOptions(options)
+    if outputPath is None and (options['trajectory'] or options['resume']):
+        raise ValueError('trajectory and resume require an outputPath')
+    if cameraIds is None: cameraIds = [int(CamId[1:]) for CamId in cameraParameters.CameraIds]
+
+    XY, visibility = np.asarray(XY), np.asarray(visibility)
+    args = argparse.Namespace(ncams=XY.shape[0], camrange=cameraIds, npoints=XY.shape[1], r=None, i=None, o=outputPath, **options)
+    app = Calibrator(args, traceCallback, referencePoints=(XY, visibility), cameraParameters=cameraParameters)
+    try:
+        app.run(iterations=iterations)
+    finally:
+        app.close()
+    return CalibrationResult(app._cameraParameters, float(app._error), list(app.outputFiles))
+
+class _AnytimeStop(Exception):
+    pass
 
 class Calibrator(object):
-    def __init__(self, args) -> None:
+    # Calibration of args.camrange cameras with options of DEFAULT_OPTIONS (and paths r, i, o) in args, reference points
+    # (coordinates, visibility flags) and initial SystemParameters are read from args.r and args.i unless given.
+    # Without args.o no params or checkpoints are written.
+    def __init__(self, args, traceCallback=None, referencePoints=None, cameraParameters=None) -> None:
         self._numberOfAllCameras        = args.ncams
         self._camerasIdsToCalibrate     = args.camrange
         self._numberOfReferencePoints   = args.npoints
         self._referencePointsPath       = args.r
         self._initCamParamsPath         = args.i
         self._outCamParamsPath          = args.o
+        self._backend                   = args.backend
+        self._solver                    = args.solver
+        self._lsJacobian                = args.lsjac
+        self._numOfWorkers              = args.workers
+        if args.threads > 0: utils.setNumThreads(args.threads)
+        self._numOfStarts               = args.starts
+        self._startNoise                = args.startnoise
+        self._loss                      = args.loss
+        self._lossScale                 = args.lossscale
+        self._pairPolicy                = args.pairs
+        self._pairMinPoints             = args.pairminpoints
+        self._pairNearest               = args.pairnearest
+        self._pairListPath              = args.pairlist
+        self._clusterSize               = args.clustersize
+        self._clusterOverlap            = args.clusteroverlap
+        self._subsampleSchedule         = args.subsample
+        self._objective                 = args.objective
+        self._exportTrajectory          = args.trajectory
+        self._resume                    = args.resume
+        self._checkpointInterval        = args.checkpointinterval
+        self._checkpointIteration       = None
+        self._chunkSize                 = args.chunkpoints
+        self._targetError               = args.targeterror
+        self._plateauTolerance          = args.plateau
+        self._plateauWindow             = args.plateauwindow
+        self._anytime                   = args.timebudget is not None or args.targeterror is not None
+        self._deadline                  = time.time() + args.timebudget if args.timebudget is not None else None
+        self._checkpointPath            = os.path.splitext(self._outCamParamsPath)[0] + '_checkpoint.npz' if self._outCamParamsPath is not None else None
+        self._firstIteration            = 0
+        self._resumeParam               = None
+        self._solution                  = None
+        self._checkpointKey             = None
+        self._warmStarted               = False
+        self._finished                  = False
+
+        # Trace of objective evaluations, rejections and global iterations (JSONL file and/or callback), continued by a resumed run
+        self._tracer = None
+        if args.trace is not None or traceCallback is not None:
+            self._tracer = instrumentation.TraceWriter(args.trace, traceCallback, append=args.resume)
         
         #self.visualise = True TODO
 
         self._cameraParameters          = None
         self._currentCamParams          = None
-        self._allReferencePoints        = None
-        self._usedReferencePoints       = None
+        self._referenceXY               = None
+        self._referenceVisibility       = None
+        self._pairPtr                   = None
+        self._pairPointIds              = None
+        self._pointErrors               = None
+        self._workspace                 = None
+        self._memo                      = None
 
         self._error       = 10000
+        self.outputFiles  = []
         
         # Handle cameras to calibrate
-        if str(self._camerasIdsToCalibrate)[0] == '[' and str(self._camerasIdsToCalibrate)[-1] == ']':
-            tmp_list = self._camerasIdsToCalibrate[1:-1].split(',')
-            self._camerasIdsToCalibrate = list(map(int, tmp_list))
-        else:
-            start, step, stop = tuple(self._camerasIdsToCalibrate.split(":"))
-            self._camerasIdsToCalibrate = np.arange(int(start), int(stop)+1, int(step))
+        self._camerasIdsToCalibrate = parseCameraRange(self._camerasIdsToCalibrate)
         self._numOfCamerasToCalibrate = len(self._camerasIdsToCalibrate)
 
-        # Load initial cam params
+        # Load initial cam params, given ones are copied as they get updated with the solution
         self._cameraParameters = parameters.SystemParameters(self._camerasIdsToCalibrate)
-        self._cameraParameters.readFrom(self._initCamParamsPath)
-    
-        self._readReferencePoints()
+        if cameraParameters is None:
+            self._cameraParameters.readFrom(self._initCamParamsPath)
+        else:
+            self._cameraParameters.Params = {CamId: copy.deepcopy(cameraParameters.Params[CamId]) for CamId in self._cameraParameters.CameraIds}
+
+        if referencePoints is None:
+            referencePoints = markers.readMarkerPositions(self._referencePointsPath, self._numberOfAllCameras)
+        self._readReferencePoints(*referencePoints)
         
         # Put rotations and translations into one list
         self._optimParam = []
@@ -55,6 +171,19 @@ class Calibrator(object):
         for count, cam in enumerate(self._camerasIdsToCalibrate):
             self.K[count][0:3, 0:3] = self._cameraParameters.IntrinsicMs['v'+str(cam)]
 
+        # Camera pairs evaluated by the objective and their co-visible reference points
+        self._workerPool = None
+        self._cameraPairs = self._selectCameraPairs()
+        if self._checkpointPath is not None: self._checkpointKey = self._calcCheckpointKey(args)
+        if self._resume and os.path.exists(self._checkpointPath): self._loadCheckpoint()
+        self._buildCoVisibilityIndex()
+
+        # Optionally split the camera pairs of the objective across worker processes,
+        # reference points and the co-visibility index are published once in shared memory
+        if self._numOfWorkers > 1:
+            self._workerPool = parallel.PairWorkerPool(self._numOfWorkers, self._referenceXY, self._pairPtr, self._pairPointIds, \
+                self.K, self._cameraPairs, self._backend, self._loss, self._lossScale)
+
         #if self._visualise: self._initVisualiser()
         return
  
@@ -62,28 +191,371 @@ class Calibrator(object):
 # Main part         
 # ===================================================================================================         
     def run(self, iterations):
-        for global_it in range(0, iterations):
+        # The checkpoint must not overwrite params or trajectories of global iterations (all of them are the output
+        # path itself when it has no .json in it)
+        if self._checkpointPath is not None:
+            outputPaths = [self._outCamParamsPath.replace('.json', f'_it{global_it}{suffix}') for global_it in range(iterations) \
+                for suffix in ['.json', '_trajectory.txt']]
+            if os.path.abspath(self._checkpointPath) in map(os.path.abspath, [self._outCamParamsPath] + outputPaths):
+                raise ValueError(f'Checkpoint {self._checkpointPath} would overwrite an output file of {self._outCamParamsPath}')
+
+        if self._finished:
+            print(f'Calibration in {self._checkpointPath} already finished.')
+            return True
+
+        if not self._warmStarted:
+            # Large rigs start from merged solutions of overlapping camera clusters, global iterations refine them
+            if self._clusterSize > 0 and self._clusterSize < self._numOfCamerasToCalibrate:
+                self._optimParam = list(self._solvePartitioned())
+
+            # Coarse-to-fine, warm-start on growing subsets of reference points before the full set
+            if self._subsampleSchedule:
+                self._optimParam = list(self._solveSubsampled())
+
+            self._warmStarted = True
+            if self._checkpointPath is not None: self._saveCheckpoint(0, False)
+
+        for global_it in range(self._firstIteration, iterations):
+            if self._tracer is not None: self._tracer.record('global iteration start', iteration=global_it, \
+                points=self._numOfActivePoints, pairs=self._numOfActivePairs, entries=int(self._pairPtr[-1]))
             
-            optimResult = optimize.minimize(\
-                        self._minFunctionExtrinsic, \
-                        self._optimParam, \
-                        method='L-BFGS-B',\
-                        options = {'disp': True, 'ftol':0.000000001, 'maxfun':1000*len(self._optimParam), 'maxcor': 100, 'maxls': 20})    
+            # A resumed run continues an unfinished solve from its saved params, L-BFGS-B checkpoints its best
+            # params periodically during the solve
+            self._checkpointIteration = global_it
+            solution = self._solve(self._resumeParam)
+            self._checkpointIteration = None
+            self._resumeParam = None
 
-            deletedPoints = self._rejectReferencePoints()
+            # Rejection is based on the epipolar distances of the solution also under the reprojection objective,
+            # the last evaluation of the solver may have been at other params or served from the memo
+            if not self._pointErrorsAt(solution):
+                self._pointErrors = self._calcEpipolarErrors(solution, self._projectionMatrices(solution), Ders=False)[1]
+
+            # Anytime mode keeps the params of an unfinished solve once time is up, without rejection,
+            # a resumed run continues the solve of the iteration from them
+            budgetExhausted = self._budgetExhausted()
+            if budgetExhausted:
+                deletedPoints = 0
+            elif self._chunkSize > 0:
+                deletedPoints = self._rejectReferencePointsChunked(solution)
+            else:
+                deletedPoints = self._rejectReferencePoints()
             
-            self._updateParams(optimResult['x'])
-            self._cameraParameters.writeTo(self._outCamParamsPath.replace('.json', f'_it{global_it}.json'))
+            self._updateParams(solution)
+            self._solution = solution
+            if self._outCamParamsPath is not None:
+                # A resumed iteration that ran out of time rewrites its files, they are listed once
+                iterationFiles = [self._outCamParamsPath.replace('.json', f'_it{global_it}.json')]
+                self._cameraParameters.writeTo(iterationFiles[0])
+                if self._exportTrajectory:
+                    iterationFiles.append(self._outCamParamsPath.replace('.json', f'_it{global_it}_trajectory.txt'))
+                    self._writeTrajectory(iterationFiles[1], solution)
+                self.outputFiles.extend(path for path in iterationFiles if path not in self.outputFiles)
+                if budgetExhausted:
+                    self._saveCheckpoint(global_it, False, resumeParam=solution)
+                else:
+                    self._saveCheckpoint(global_it + 1, deletedPoints == 0)
+            if self._tracer is not None: self._tracer.record('global iteration end', iteration=global_it, error=self._error, rejected=deletedPoints)
         
             print('===========================================================================')
             print(f'[{global_it}] global iteration ended.') 
             print(f'[{deletedPoints}] reference points rejected')
-            print(f'Saving params to {self._outCamParamsPath.replace(".json", "_it"+str(global_it)+".json")}.')
+            if self._outCamParamsPath is not None: print(f'Saving params to {self._outCamParamsPath.replace(".json", "_it"+str(global_it)+".json")}.')
             print('===========================================================================\n')
             
+            if budgetExhausted:
+                print('Time budget exhausted, best params saved.')
+                break
+            if self._targetError is not None and self._error <= self._targetError:
+                print('Target error reached.')
+                break
             if deletedPoints == 0: break
 
         return True
+
+    def _saveCheckpoint(self, nextIteration, finished, resumeParam=None) -> bool:
+        # State needed to continue run(): start params, surviving reference points, camera pairs, the next
+        # global iteration and the params its unfinished solve continues from (empty when it starts anew), and the
+        # solution, error and output files of the last global iteration (empty solution before the first one),
+        # written to a temporary file first so that an interrupted save keeps the previous one
+        temporaryPath = self._checkpointPath + '.tmp'
+        resumeParam = np.zeros(0) if resumeParam is None else np.asarray(resumeParam, dtype=np.float64)
+        solution = np.zeros(0) if self._solution is None else np.asarray(self._solution, dtype=np.float64)
+        with open(temporaryPath, 'wb') as f:
+            np.savez(f, optimParam=np.asarray(self._optimParam, dtype=np.float64), resumeParam=resumeParam, visibility=self._referenceVisibility, \
+                cameraPairs=self._cameraPairs, cameraIds=np.asarray(self._camerasIdsToCalibrate), numOfPoints=self._numberOfReferencePoints, \
+                nextIteration=nextIteration, finished=finished, warmStarted=self._warmStarted, solution=solution, key=self._checkpointKey, \
+                error=float(self._error), outputFiles=np.asarray(self.outputFiles, dtype=str))
+        os.replace(temporaryPath, self._checkpointPath)
+        return True
+
+    def _calcCheckpointKey(self, args) -> str:
+        # Key of the inputs and of the options a checkpoint can only be resumed with, as the key of the result cache
+        options = {name: getattr(args, name) for name in DEFAULT_OPTIONS if name not in _RESUMABLE_OPTIONS}
+        options.update(ncams=self._numberOfAllCameras, npoints=self._numberOfReferencePoints, cameraIds=list(map(int, self._camerasIdsToCalibrate)))
+        return resultcache.calcCacheKey([np.asarray(self._referenceXY), self._referenceVisibility, \
+            np.asarray(self._optimParam, dtype=np.float64), self.K, np.asarray(self._cameraPairs)], options)
+
+    def _loadCheckpoint(self) -> bool:
+        with np.load(self._checkpointPath) as checkpoint:
+            if 'key' not in checkpoint or str(checkpoint['key']) != self._checkpointKey:
+                raise ValueError(f'{self._checkpointPath} is a checkpoint of other inputs or options, it cannot be resumed')
+            self._optimParam            = list(checkpoint['optimParam'])
+            self._referenceVisibility   = checkpoint['visibility']
+            self._cameraPairs           = checkpoint['cameraPairs']
+            self._firstIteration        = int(checkpoint['nextIteration'])
+            self._finished              = bool(checkpoint['finished'])
+            self._warmStarted           = bool(checkpoint['warmStarted'])
+            if 'resumeParam' in checkpoint and len(checkpoint['resumeParam']) > 0:
+                self._resumeParam       = checkpoint['resumeParam']
+            # A finished run or one without iterations left returns the result of its last global iteration
+            if 'solution' in checkpoint and len(checkpoint['solution']) > 0:
+                self._solution          = checkpoint['solution']
+                self._error             = float(checkpoint['error'])
+                self.outputFiles        = [str(path) for path in checkpoint['outputFiles']]
+                self._updateParams(self._solution)
+
+        print(f'Resuming from {self._checkpointPath} at global iteration {self._firstIteration}' + \
+            (' (unfinished solve)' if self._resumeParam is not None else '') + '.')
+        return True
+
+    def _solve(self, startParam=None):
+        # Solve from startParam, by default from the start params of the calibration
+        startParam = self._optimParam if startParam is None else startParam
+        if self._solver == 'least_squares':
+            return self._solveLeastSquares(startParam)
+        elif self._numOfStarts > 1:
+            return self._solveMultiStart(startParam)
+        else:
+            return self.minimize(startParam)['x']
+
+    def minimize(self, optimParam, monitor=None):
+        # L-BFGS-B from given params, monitor(x, f) is called after every evaluation and may raise to stop.
+        # In anytime mode it also stops on the time budget, the target error or a plateau of the best error
+        # and returns the best params seen so far. Within a global iteration of run() the best params are
+        # checkpointed every checkpoint interval.
+        from scipy import optimize
+        checkpointing = self._checkpointIteration is not None and self._checkpointPath is not None and self._checkpointInterval > 0
+        best = {'x': np.array(optimParam, dtype=np.float64), 'fun': np.inf, 'history': [], 'checkpoint': time.time()}
+        def monitoredObjective(x):
+            er, grad = self._minFunctionExtrinsicDers(x)
+            if monitor is not None: monitor(x, er)
+            if er < best['fun']: best['x'], best['fun'] = np.array(x), er
+            if checkpointing and time.time() - best['checkpoint'] >= self._checkpointInterval:
+                self._saveCheckpoint(self._checkpointIteration, False, resumeParam=best['x'])
+                best['checkpoint'] = time.time()
+                if self._tracer is not None: self._tracer.record('checkpoint', iteration=self._checkpointIteration, error=best['fun'])
+            if self._anytime:
+                best['history'].append(best['fun'])
+                self._checkAnytimeStop(best['history'])
+            return er, grad
+
+        monitored = monitor is not None or self._anytime or checkpointing
+        objective = monitoredObjective if monitored else self._minFunctionExtrinsicDers
+
+        try:
+            return optimize.minimize(\
+                    objective, \
+                    optimParam, \
+                    method='L-BFGS-B',\
+                    jac=True,\
+                    options = {'disp': monitor is None, 'ftol':0.000000001, 'maxfun':1000*len(optimParam), 'maxcor': 100, 'maxls': 20})
+        except _AnytimeStop as stop:
+            # Per-point errors of the best params for rejection of reference points
+            self._minFunctionExtrinsic(best['x'])
+            print(f'L-BFGS-B stopped after {len(best["history"])} evaluations: {stop}, best error {best["fun"]}')
+            if self._tracer is not None: self._tracer.record('anytime stop', reason=str(stop), error=best['fun'], evaluations=len(best['history']))
+            return optimize.OptimizeResult(x=best['x'], fun=best['fun'], nfev=len(best['history']), success=False, message=str(stop))
+
+    def _checkAnytimeStop(self, history):
+        # Best error of every evaluation so far, stops when the budget runs out, the target error is reached
+        # or the best error improved by less than the plateau tolerance over the plateau window
+        if self._budgetExhausted():
+            raise _AnytimeStop('time budget exhausted')
+        if self._targetError is not None and history[-1] <= self._targetError:
+            raise _AnytimeStop('target error reached')
+        window = self._plateauWindow
+        if len(history) > window and history[-window-1] - history[-1] <= self._plateauTolerance * history[-1]:
+            raise _AnytimeStop(f'improvement below {self._plateauTolerance} over {window} evaluations')
+        return
+
+    def _budgetExhausted(self):
+        return self._deadline is not None and time.time() >= self._deadline
+
+    def _solveMultiStart(self, startParam):
+        # Start params plus randomly perturbed copies, solved concurrently, the lowest error wins
+        rng = np.random.default_rng(0)
+        starts = [np.array(startParam, dtype=np.float64)]
+        for _ in range(self._numOfStarts - 1):
+            starts.append(starts[0] + rng.normal(0, self._startNoise, len(starts[0])))
+
+        results = parallel.runMultiStart(self, starts)
+
+        for startId, (solution, er, nfev, stopped) in enumerate(results):
+            print(f'Start {startId}: error {er} after {nfev} evaluations' + (' (stopped early)' if stopped else ''))
+        bestId = int(np.argmin([er for _, er, _, _ in results]))
+        print(f'Start {bestId} selected')
+
+        # Per-point errors of the selected solution for rejection of reference points
+        self._minFunctionExtrinsic(results[bestId][0])
+        return results[bestId][0]
+
+    def _solveLeastSquares(self, startParam):
+        # Minimize the per-(pair, point) residuals, each of them depends only on the params of two cameras
+        from scipy import optimize
+        self._prepareResiduals()
+
+        loss = 'linear' if self._loss == 'none' else self._residualsLoss
+        if self._lsJacobian == 'analytic':
+            lsResult = optimize.least_squares(self._residuals, startParam, jac=self._residualsJacobian, loss=loss, \
+                method='trf', tr_solver='lsmr', ftol=0.000001, verbose=2)
+        else:
+            lsResult = optimize.least_squares(self._residuals, startParam, jac='2-point', jac_sparsity=self._residualsJacSparsity(), loss=loss, \
+                method='trf', tr_solver='lsmr', ftol=0.000001, verbose=2)
+
+        # Per-point errors of the solution for rejection of reference points
+        self._minFunctionExtrinsic(lsResult['x'])
+        print(f'Least squares finished after {lsResult["nfev"]} evaluations, mean error {self._error}')
+
+        return lsResult['x']
+
+    def _solveSubsampled(self):
+        # Solve on spatially stratified subsets of reference points given by the schedule of fractions,
+        # each stage starts from the solution of the previous one
+        fullVisibility = self._referenceVisibility
+        optimParam = np.array(self._optimParam, dtype=np.float64)
+        numOfEntries = self._pairPtr[-1]
+
+        for fraction in sorted(self._subsampleSchedule):
+            selected = utils.selectStratifiedPoints(self._referenceXY, fullVisibility, self._numberOfReferencePoints, fraction)
+            self._referenceVisibility = fullVisibility & np.packbits(selected)[None, :]
+            self._buildCoVisibilityIndex()
+            self._optimParam = list(optimParam)
+            optimParam = np.asarray(self._solve(), dtype=np.float64)
+
+            print('===========================================================================')
+            print(f'Subsample {fraction}: {selected.sum()} of {self._numberOfReferencePoints} reference points, ' \
+                f'{self._pairPtr[-1]} of {numOfEntries} co-visible point pairs, error {self._minFunctionExtrinsic(optimParam)}')
+            print('===========================================================================\n')
+
+        self._referenceVisibility = fullVisibility
+        self._buildCoVisibilityIndex()
+        return optimParam
+
+    def _solvePartitioned(self):
+        # Calibrate overlapping clusters of co-visible cameras concurrently and merge them into the frame of the first
+        # cluster, every next cluster is aligned by a similarity transform through the cameras shared with previous ones
+        from scipy.spatial.transform import Rotation
+        allPairs = utils.getCameraPairs(self._numOfCamerasToCalibrate)
+        coVisibility = np.zeros((self._numOfCamerasToCalibrate, self._numOfCamerasToCalibrate), dtype=np.int64)
+        coVisibility[allPairs[:,0], allPairs[:,1]] = utils.countCoVisiblePoints(self._referenceVisibility, allPairs)
+        coVisibility += coVisibility.T
+        clusters = utils.partitionCameras(coVisibility, self._clusterSize, self._clusterOverlap)
+
+        print('===========================================================================')
+        print(f'Partitioned calibration of {len(clusters)} camera clusters')
+        for clusterId, cameraIndices in enumerate(clusters):
+            print(f'Cluster {clusterId}: ' + ', '.join(f'v{CamId}' for CamId in np.asarray(self._camerasIdsToCalibrate)[cameraIndices]))
+        print('===========================================================================\n')
+
+        results = parallel.runPartitions([self._subCalibrator(cameraIndices) for cameraIndices in clusters])
+
+        params = np.array(self._optimParam, dtype=np.float64).reshape(-1, 7)
+        merged = np.zeros(self._numOfCamerasToCalibrate, dtype=bool)
+        print('===========================================================================')
+        for clusterId, (cameraIndices, (solution, er)) in enumerate(zip(clusters, results)):
+            solution = solution.reshape(-1, 7)
+            rotations = Rotation.from_quat(solution[:, 0:4]).as_matrix()
+            shared = merged[cameraIndices]
+            if shared.any():
+                Q, scale, T = utils.calcSimilarityTransform(rotations[shared], solution[shared, 4:7], \
+                    Rotation.from_quat(params[cameraIndices[shared], 0:4]).as_matrix(), params[cameraIndices[shared], 4:7])
+            else:
+                Q, scale, T = np.eye(3), 1.0, np.zeros(3)
+
+            added = cameraIndices[~shared]
+            params[added, 0:4] = Rotation.from_matrix(rotations[~shared] @ Q.T).as_quat()
+            params[added, 4:7] = scale * solution[~shared, 4:7] @ Q.T + T
+            merged[added] = True
+            print(f'Cluster {clusterId}: error {er}, {shared.sum()} shared cameras, alignment scale {scale:.4f}')
+        print('===========================================================================\n')
+
+        # Bring the merged rig back to the frame of the initial params
+        initParams = np.array(self._optimParam, dtype=np.float64).reshape(-1, 7)
+        rotations = Rotation.from_quat(params[:, 0:4]).as_matrix()
+        Q, scale, T = utils.calcSimilarityTransform(rotations, params[:, 4:7], Rotation.from_quat(initParams[:, 0:4]).as_matrix(), initParams[:, 4:7])
+        params[:, 0:4] = Rotation.from_matrix(rotations @ Q.T).as_quat()
+        params[:, 4:7] = scale * params[:, 4:7] @ Q.T + T
+
+        return params.flatten()
+
+    def _subCalibrator(self, cameraIndices):
+        # Copy of the problem restricted to the given cameras and the selected pairs among them, solved in-process
+        sub = copy.copy(self)
+        sub._camerasIdsToCalibrate      = np.asarray(self._camerasIdsToCalibrate)[cameraIndices]
+        sub._numOfCamerasToCalibrate    = len(cameraIndices)
+        sub._optimParam                 = list(np.array(self._optimParam, dtype=np.float64).reshape(-1, 7)[cameraIndices].flatten())
+        sub.K                           = self.K[cameraIndices]
+        sub._referenceXY                = self._referenceXY[cameraIndices]
+        sub._referenceVisibility        = self._referenceVisibility[cameraIndices]
+        sub._pointErrors                = None
+        sub._workspace                  = None
+        sub._memo                       = None
+        sub._numOfWorkers               = 1
+        sub._numOfStarts                = 1
+        sub._clusterSize                = 0
+
+        subIndices = np.full(self._numOfCamerasToCalibrate, -1)
+        subIndices[cameraIndices] = np.arange(len(cameraIndices))
+        pairs = subIndices[self._cameraPairs]
+        sub._cameraPairs = pairs[np.all(pairs >= 0, axis=1)]
+        sub._buildCoVisibilityIndex()
+        return sub
+
+    def checkGradient(self, perturbation=0.0, epsilon=1e-6) -> bool:
+        # Compare the analytic gradient with central finite differences at the initial parameters.
+        # Points lying exactly on their epipolar lines (e.g. the linear initial arrangement) are kinks
+        # of the distance, so the initial parameters can be optionally perturbed by Gaussian noise.
+        optimParam = np.array(self._optimParam, dtype=np.float64)
+        optimParam = optimParam + np.random.default_rng(0).normal(0, perturbation, len(optimParam))
+        _, analyticGrad = self._minFunctionExtrinsicDers(optimParam)
+
+        numericGrad = np.zeros(len(optimParam))
+        for n in range(len(optimParam)):
+            step = np.zeros(len(optimParam))
+            step[n] = epsilon
+            numericGrad[n] = (self._minFunctionExtrinsic(optimParam + step) - self._minFunctionExtrinsic(optimParam - step)) / (2 * epsilon)
+
+        absError = np.abs(analyticGrad - numericGrad)
+        relError = np.linalg.norm(analyticGrad - numericGrad) / max(np.linalg.norm(numericGrad), np.finfo(np.float64).tiny)
+
+        print('===========================================================================')
+        print('Gradient check (analytic vs central finite differences)')
+        for i, CamId in enumerate(self._camerasIdsToCalibrate):
+            print(f'v{CamId}: max abs error {absError[7*i:7*i+7].max():.3e}')
+        print(f'Max abs error: {absError.max():.3e}')
+        print(f'Relative error: {relError:.3e}')
+        print('===========================================================================\n')
+
+        return relError < 1e-4
+
+    def __getstate__(self):
+        # Copies sent to other processes evaluate the objective in-process
+        state = self.__dict__.copy()
+        state['_workerPool'] = None
+        state['_tracer'] = None
+        state['_checkpointIteration'] = None
+        return state
+
+    def close(self) -> None:
+        if self._workerPool is not None:
+            if self._pointErrors is not None: self._pointErrors = np.array(self._pointErrors)
+            self._workerPool.close()
+            self._workerPool = None
+        if self._tracer is not None:
+            self._tracer.close()
+            self._tracer = None
+        return
     
 # ===================================================================================================
 #  Functions
@@ -101,113 +573,412 @@ class Calibrator(object):
 
         return True
 
-    def _readReferencePoints(self) -> bool:
-        # Read calibration points
-        with open(self._referencePointsPath) as f:
-            points_array = np.loadtxt(f, delimiter='\t')
-            assert points_array.shape == (self._numberOfReferencePoints, self._numberOfAllCameras * 3)
-            
-            # Convert array of points into subsets of points for each camera
-            self._allReferencePoints = np.zeros((self._numberOfAllCameras, self._numberOfReferencePoints, 3))
-            for cam in range(self._numberOfAllCameras):   
-                self._allReferencePoints[cam] = points_array[:,cam*3:(cam*3)+3]
-            f.close()
-
-        # Use only reference points for cameras to calibrate   
-        self._usedReferencePoints = np.zeros((self._numOfCamerasToCalibrate,self._numberOfReferencePoints,3))
-        for count, cam in enumerate(self._camerasIdsToCalibrate):
-            self._usedReferencePoints[count] = self._allReferencePoints[cam]
+    def _readReferencePoints(self, XY, visibility) -> bool:
+        # Calibration points of all cameras, binary stores stay memory-mapped
+        assert XY.shape[0] == self._numberOfAllCameras and XY.shape[1] == self._numberOfReferencePoints, \
+            f'Reference points of {XY.shape[0]} cameras and {XY.shape[1]} points, expected {self._numberOfAllCameras} and {self._numberOfReferencePoints}'
+
+        # Use only reference points for cameras to calibrate (a view without copy when they form a range),
+        # kept as float32 coordinates and visibility bitsets built one chunk of points at a time
+        ids = np.asarray(self._camerasIdsToCalibrate)
+        step = ids[1] - ids[0] if len(ids) > 1 else 1
+        if step > 0 and np.all(np.diff(ids) == step):
+            cameras = slice(int(ids[0]), int(ids[-1]) + 1, int(step))
+        else:
+            cameras = ids
+        self._referenceXY = np.asarray(XY[cameras])
+
+        self._referenceVisibility = np.zeros((self._numOfCamerasToCalibrate, (self._numberOfReferencePoints + 7) // 8), dtype=np.uint8)
+        for begin, end in self._pointChunks():
+            # Probably remove the closest calibration points to frame boundaries
+            visible = (visibility[cameras, begin:end] == 1) & ~self._pointCondition(self._referenceXY[:, begin:end])
+            self._referenceVisibility[:, begin//8:(end+7)//8] = np.packbits(visible, axis=1)
+
+        return True
+
+    def _pointChunks(self):
+        # Ranges of points of at most the chunk size, chunks start on whole bytes of the visibility bitsets
+        chunkSize = ((self._chunkSize if self._chunkSize > 0 else 1 << 20) + 7) // 8 * 8
+        for begin in range(0, self._numberOfReferencePoints, chunkSize):
+            yield begin, min(begin + chunkSize, self._numberOfReferencePoints)
+
+    def _selectCameraPairs(self):
+        # Pairs evaluated by the objective according to the pair policy, with a report of the retained coverage
+        allPairs = utils.getCameraPairs(self._numOfCamerasToCalibrate)
+        numOfPoints = utils.countCoVisiblePoints(self._referenceVisibility, allPairs)
+
+        if self._pairPolicy == 'all':
+            return allPairs
+        elif self._pairPolicy == 'covisible':
+            pairs = allPairs[numOfPoints >= self._pairMinPoints]
+        elif self._pairPolicy == 'nearest':
+            positions = np.array(self._optimParam).reshape(-1, 7)[:, 4:7]
+            pairs = utils.selectNearestCameraPairs(positions, self._pairNearest)
+        elif self._pairPolicy == 'list':
+            pairs = self._readCameraPairs()
+        else:
+            raise ValueError(f'Unknown camera pair policy {self._pairPolicy}')
+
+        selected = np.zeros(len(allPairs), dtype=bool)
+        selected[np.searchsorted(allPairs[:,0] * self._numOfCamerasToCalibrate + allPairs[:,1], \
+            pairs[:,0] * self._numOfCamerasToCalibrate + pairs[:,1])] = True
+        coveredCams = len(np.unique(pairs))
+        components = utils.countConnectedComponents(self._numOfCamerasToCalibrate, pairs)
 
-        # Probably remove the closest calibration points to frame boundaries
-        for c in range(self._numOfCamerasToCalibrate):
-            for p in range(self._numberOfReferencePoints):
-                if self._usedReferencePoints[c][p][0] > 0:
-                    if self._pointCondition(c, p):
-                           self._usedReferencePoints[c][p] = np.zeros((1,3))
+        print('===========================================================================')
+        print(f'Camera pair policy: {self._pairPolicy}')
+        print(f'Pairs: {len(pairs)} of {len(allPairs)} ({100 * len(pairs) / max(len(allPairs), 1):.1f}%)')
+        print(f'Co-visible point pairs: {numOfPoints[selected].sum()} of {numOfPoints.sum()} ({100 * numOfPoints[selected].sum() / max(numOfPoints.sum(), 1):.1f}%)')
+        print(f'Cameras covered: {coveredCams} of {self._numOfCamerasToCalibrate}, connected components: {components}')
+        if components > 1: print('WARNING: selected camera pairs do not connect all cameras')
+        print('===========================================================================\n')
+        if len(pairs) == 0:
+            raise ValueError(f'Camera pair policy {self._pairPolicy} selected no camera pairs' + \
+                (f', no pair has {self._pairMinPoints} co-visible points' if self._pairPolicy == 'covisible' else ''))
+        return pairs
 
+    def _readCameraPairs(self):
+        # Explicit pairs of camera ids, one pair per line ("3 7" or "v3 v7"), pairs of other cameras are ignored
+        camIndices = {int(cam): index for index, cam in enumerate(self._camerasIdsToCalibrate)}
+        pairs, ignored = [], 0
+        with open(self._pairListPath) as f:
+            for lineNumber, line in enumerate(f, 1):
+                ids = line.replace(',', ' ').replace('v', '').split()
+                if len(ids) == 0 or ids[0].startswith('#'): continue
+                if len(ids) < 2 or not (ids[0].isdigit() and ids[1].isdigit()):
+                    raise ValueError(f'{self._pairListPath}: line {lineNumber}: expected a pair of camera ids, got {line.strip()!r}')
+                if int(ids[0]) in camIndices and int(ids[1]) in camIndices:
+                    pairs.append((camIndices[int(ids[0])], camIndices[int(ids[1])]))
+                else:
+                    ignored += 1
+        if ignored > 0: print(f'{ignored} listed camera pairs ignored (cameras not calibrated)')
+        return utils.sortCameraPairs(pairs)
+
+    def _buildCoVisibilityIndex(self) -> bool:
+        if self._chunkSize > 0:
+            self._countCoVisiblePoints()
+            return self._prepareWorkspace()
+
+        # Ids of points visible in both cameras of each pair, errors are stored in the same order
+        self._pairPtr, self._pairPointIds = utils.buildCoVisibilityIndex(self._referenceVisibility, self._numberOfReferencePoints, self._cameraPairs)
+        if self._workerPool is not None: self._workerPool.updateIndex(self._pairPtr, self._pairPointIds)
+        self._numOfActivePoints = int(np.count_nonzero(np.bincount(self._pairPointIds, minlength=1)))
+        self._numOfActivePairs = int(np.count_nonzero(np.diff(self._pairPtr)))
+
+        # Points visible in at least two cameras are triangulated by the reprojection objective
+        if self._objective == 'reprojection':
+            self._referenceVisible = np.unpackbits(self._referenceVisibility, axis=1, count=self._numberOfReferencePoints).astype(bool)
+            self._triangulatedPointIds = np.flatnonzero(np.sum(self._referenceVisible, axis=0) >= 2)
+        return self._prepareWorkspace()
+
+    def _prepareWorkspace(self) -> bool:
+        # Buffers of evaluations are reused while they fit the index, memoized evaluations belong to the previous index
+        numOfParams = 7 * self._numOfCamerasToCalibrate
+        numOfEntries = len(self._pairPointIds) if self._pairPointIds is not None else 0
+        numpyScratch = self._workerPool is None and self._chunkSize == 0 and utils.resolveBackend(self._backend) == 'numpy'
+        if self._workspace is None or not self._workspace.fits(numOfParams, len(self._cameraPairs), numOfEntries, numpyScratch):
+            self._workspace = workspace.EvaluationWorkspace(numOfParams, len(self._cameraPairs), numOfEntries, numpyScratch)
+            self._memo = workspace.EvaluationMemo(numOfParams)
+        self._workspace.lastParam[:] = np.nan
+        self._memo.clear()
         return True
+
+    def _pointErrorsAt(self, optimParam):
+        # Whether the kept per-point errors were computed at these params (chunked evaluation keeps none)
+        return self._chunkSize > 0 or np.array_equal(self._workspace.lastParam, optimParam)
+
+    def _countCoVisiblePoints(self) -> bool:
+        # Chunked evaluation keeps only the number of co-visible points of each pair (PairPtr),
+        # ids of the points are rebuilt for one chunk at a time
+        self._pairPtr = np.zeros(len(self._cameraPairs)+1, dtype=np.int64)
+        self._pairPtr[1:] = np.cumsum(utils.countCoVisiblePoints(self._referenceVisibility, self._cameraPairs))
+        self._pairPointIds = None
+        self._numOfActivePoints = 0
+        for begin, end in self._pointChunks():
+            numOfCams = np.sum(np.unpackbits(self._referenceVisibility[:, begin//8:(end+7)//8], axis=1, count=end-begin), axis=0)
+            self._numOfActivePoints += int(np.count_nonzero(numOfCams >= 2))
+        self._numOfActivePairs = int(np.count_nonzero(np.diff(self._pairPtr)))
+        return True
+
+    def _chunkCoVisibilityIndices(self):
+        # CSR index of co-visible points of every chunk (see buildCoVisibilityIndex) with global point ids
+        for begin, end in self._pointChunks():
+            pairPtr, pairPointIds = utils.buildCoVisibilityIndex(self._referenceVisibility[:, begin//8:(end+7)//8], end - begin, self._cameraPairs)
+            yield pairPtr, pairPointIds + np.int32(begin)
        
     def _rejectReferencePoints(self):
-        k = 0
-        deletedPoints = 0
-        for i in range(self._numOfCamerasToCalibrate):
-            for j in range(i+1,self._numOfCamerasToCalibrate):
-                if i is not j:
-                    for p in range(self._numberOfReferencePoints):
-                        if self._point_err_2[p,k] >  10 * self._error:
-                            self._usedReferencePoints[i,p,0:3] = np.array([-1.0,-1.0,0])
-                            self._usedReferencePoints[j,p,0:3] = np.array([-1.0,-1.0,0])
-                            deletedPoints = deletedPoints + 1
-                            print('Cams ',i,' and ',j, ' point number ',p,' error ', self._point_err_2[p,k],'\n')
-                    k = k+1
+        # Reject points of both cameras of a pair where the distance exceeds 10x the mean distance
+        numOfPoints = np.diff(self._pairPtr)
+        entryPairs = np.repeat(np.arange(len(self._cameraPairs)), numOfPoints)
+        pairMeans = np.bincount(entryPairs, weights=self._pointErrors, minlength=len(self._cameraPairs)) / np.maximum(numOfPoints, 1)
+        meanError = np.mean(pairMeans)
+        rejected = np.flatnonzero(self._pointErrors > 10 * meanError)
+        return self._clearRejectedPoints(meanError, np.max(self._pointErrors, initial=0.0), entryPairs[rejected], self._pairPointIds[rejected])
+
+    def _rejectReferencePointsChunked(self, optimParam):
+        # Rejection of _rejectReferencePoints with distances at the solution recomputed one chunk of points at a time,
+        # the first pass gives the mean distance and the second one the points above the threshold
+        F = utils.calcFundamentalMatrices(self._projectionMatrices(optimParam), self._cameraPairs)
+        pairIds = np.arange(len(self._cameraPairs))
+        pairSums, maxError = np.zeros(len(self._cameraPairs)), 0.0
+        for pairPtr, pairPointIds in self._chunkCoVisibilityIndices():
+            _, point_err, _ = utils.calcEpipolarErrors(self._referenceXY, F, self._cameraPairs, pairPtr, pairPointIds, \
+                Backend=self._backend, Loss=self._loss, LossScale=self._lossScale)
+            pairSums += np.bincount(np.repeat(pairIds, np.diff(pairPtr)), weights=point_err, minlength=len(pairIds))
+            maxError = max(maxError, np.max(point_err, initial=0.0))
+        meanError = np.mean(pairSums / np.maximum(np.diff(self._pairPtr), 1))
+
+        rejectedPairs, rejectedPoints = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int32)]
+        for pairPtr, pairPointIds in self._chunkCoVisibilityIndices():
+            _, point_err, _ = utils.calcEpipolarErrors(self._referenceXY, F, self._cameraPairs, pairPtr, pairPointIds, \
+                Backend=self._backend, Loss=self._loss, LossScale=self._lossScale)
+            rejected = np.flatnonzero(point_err > 10 * meanError)
+            rejectedPairs.append(np.repeat(pairIds, np.diff(pairPtr))[rejected])
+            rejectedPoints.append(pairPointIds[rejected])
+        return self._clearRejectedPoints(meanError, maxError, np.concatenate(rejectedPairs), np.concatenate(rejectedPoints))
+
+    def _clearRejectedPoints(self, meanError, maxError, rejectedPairs, points):
+        deletedPoints = len(points)
+        if deletedPoints == 0:
+            if self._tracer is not None: self._tracer.record('rejection', threshold=10 * meanError, mean_error=meanError, rejected=0)
+            return 0
+
+        # Clear visibility bits of the rejected points in both cameras of their pairs
+        bitMasks = np.invert(np.left_shift(np.uint8(1), (7 - points % 8).astype(np.uint8)))
+        for side in range(2):
+            np.bitwise_and.at(self._referenceVisibility, (self._cameraPairs[rejectedPairs, side], points // 8), bitMasks)
+        rejectedPerCam = [len(np.unique(points[np.any(self._cameraPairs[rejectedPairs] == c, axis=1)])) for c in range(self._numOfCamerasToCalibrate)]
+        pairsWithRejections = len(np.unique(rejectedPairs))
+
+        if self._tracer is not None: self._tracer.record('rejection', threshold=10 * meanError, mean_error=meanError, \
+            rejected=deletedPoints, pairs_with_rejections=pairsWithRejections, rejected_per_camera=rejectedPerCam)
+
+        print(f'Rejection threshold {10 * meanError:.3f} (10x mean error {meanError:.3f}), max error {maxError:.3f}')
+        print(f'{deletedPoints} point errors above threshold in {pairsWithRejections} of {len(self._cameraPairs)} camera pairs')
+        print('Rejected points per camera: ' + ', '.join(f'v{CamId}:{n}' for CamId, n in zip(self._camerasIdsToCalibrate, rejectedPerCam)))
+
+        self._buildCoVisibilityIndex()
         return deletedPoints
 
     def _minFunctionExtrinsic(self, optimParam):
-        E = np.full((self._numOfCamerasToCalibrate,4,4),np.zeros(4))
-        P = np.full((self._numOfCamerasToCalibrate,4,4),np.zeros(4))
-        
-        for i in range(self._numOfCamerasToCalibrate):
-            # Unpack quaterions and rotations for each camera
-            RotationQ = [optimParam[7*i], optimParam[7*i+1], optimParam[7*i+2], optimParam[7*i+3]]
-            RotationM = Rotation.from_quat(RotationQ).as_matrix()
-            TranslationV  = np.array([optimParam[7*i+4], optimParam[7*i+5], optimParam[7*i+6]])
-            
-            E[i,:,:] = self._extrinsicMatrix(TranslationV, RotationM)
-            P[i,:,:] = self._projectionMatrix(self.K[i,:,:], E[i,:,:])
-        
-        
-        self._point_err_2 = np.zeros((self._numberOfReferencePoints, self._numOfCamerasToCalibrate*self._numOfCamerasToCalibrate-self._numOfCamerasToCalibrate))
-        m = np.zeros((self._numOfCamerasToCalibrate, self._numberOfReferencePoints, 3))
-        
-        for c in range(self._numOfCamerasToCalibrate):
-            m[c,:,:] = self._usedReferencePoints[c]
-            
-        er, self._point_err_2 = self._targetErrorAllCam(P)
+        start = time.perf_counter()
+        memoized = self._memo.lookup(optimParam, ders=False)
+        if memoized is not None and (self._objective == 'reprojection' or self._pointErrorsAt(optimParam)):
+            self._error = memoized[0]
+            if self._tracer is not None: self._traceEvaluation('objective', start, error=self._error, memoized=True)
+            return self._error
+
+        P = self._projectionMatrices(optimParam)
+
+        er, self._pointErrors = self._targetErrorAllCam(optimParam, P)
 
         self._error = er
+        self._memo.store(optimParam, er)
+        if self._tracer is not None: self._traceEvaluation('objective', start, error=er)
 
         return er 
+
+    def _prepareResiduals(self):
+        # Co-visible (pair, point) entries of the co-visibility index define the residual vector
+        numOfPoints = np.diff(self._pairPtr)
+        self._residualPtr = self._pairPtr
+        self._residualPairs = np.repeat(np.arange(len(self._cameraPairs)), numOfPoints)
+        self._residualM1 = np.ones((len(self._pairPointIds), 3))
+        self._residualM0 = np.ones((len(self._pairPointIds), 3))
+        self._residualM1[:,0:2] = self._referenceXY[self._cameraPairs[self._residualPairs,0], self._pairPointIds]
+        self._residualM0[:,0:2] = self._referenceXY[self._cameraPairs[self._residualPairs,1], self._pairPointIds]
+
+        # Sum of squares equals the mean over pairs of mean squared distances, as in _targetErrorAllCam
+        self._residualWeights = 1 / np.sqrt(numOfPoints[self._residualPairs] * len(self._cameraPairs))
+
+        # Each residual depends on the 7 params of both cameras of its pair
+        columns = np.concatenate([7*self._cameraPairs[:,0:1] + np.arange(7), 7*self._cameraPairs[:,1:2] + np.arange(7)], axis=1)
+        self._residualColumns = columns[self._residualPairs].flatten()
+
+        # Epipolar distances do not change with a similarity transform of all cameras or with the norm of quaternions,
+        # the gauge is fixed at the initial params of the first camera and the distance between the first two cameras
+        self._gaugeParam = np.array(self._optimParam[0:7], dtype=np.float64)
+        self._gaugeDistance = np.linalg.norm(np.subtract(self._optimParam[11:14], self._optimParam[4:7]))
+        return True
+
+    def _residualsJacSparsity(self):
+        from scipy import sparse
+        numOfResiduals = len(self._residualPairs)
+        epipolar = sparse.csr_matrix((np.ones(14*numOfResiduals), self._residualColumns, np.arange(0, 14*numOfResiduals+1, 14)), \
+            shape=(numOfResiduals, len(self._optimParam)))
+        gauge = self._gaugeResidualsJacobian(self._optimParam)
+        gauge.data[:] = 1
+        return sparse.vstack([epipolar, gauge], format='csr')
+
+    def _residualsLoss(self, z):
+        # Robust loss of squared weighted residuals z = (w*d)^2, applied to the distances d themselves,
+        # i.e. w^2 * c^2 * rho((d/c)^2). Gauge residuals stay quadratic.
+        numOfEpipolar = len(self._residualWeights)
+        rho = np.array([z, np.ones_like(z), np.zeros_like(z)])
+        scale = (self._residualWeights * self._lossScale)**2
+        rho0, rho1, rho2 = utils.calcRobustLoss(z[:numOfEpipolar] / scale, self._loss)
+        rho[:, :numOfEpipolar] = [rho0 * scale, rho1, rho2 / scale]
+        return rho
+
+    def _residuals(self, optimParam):
+        start = time.perf_counter()
+        P = self._projectionMatrices(optimParam)
+        F = utils.calcFundamentalMatrices(P, self._cameraPairs)
+        r, _ = utils.calcEpipolarResiduals(self._residualM1, F, self._residualM0, self._residualPairs)
+        residuals = np.concatenate([r * self._residualWeights, self._gaugeResiduals(optimParam)])
+        if self._tracer is not None: self._traceEvaluation('residuals', start, cost=0.5 * float(np.sum(residuals * residuals)))
+        return residuals
+
+    def _gaugeResiduals(self, optimParam):
+        optimParam = np.asarray(optimParam, dtype=np.float64)
+        RotationQs = np.reshape(optimParam, (-1, 7))[:,0:4]
+        return np.concatenate([
+            optimParam[0:7] - self._gaugeParam,
+            [np.linalg.norm(optimParam[11:14] - optimParam[4:7]) - self._gaugeDistance],
+            np.sum(RotationQs*RotationQs, axis=1) - 1])
+
+    def _gaugeResidualsJacobian(self, optimParam):
+        from scipy import sparse
+        optimParam = np.asarray(optimParam, dtype=np.float64)
+        numOfParams = len(optimParam)
+        baseline = optimParam[11:14] - optimParam[4:7]
+        baseline = baseline / np.linalg.norm(baseline)
+
+        rows    = [np.arange(7), np.full(6, 7)] + [np.full(4, 8+i) for i in range(self._numOfCamerasToCalibrate)]
+        columns = [np.arange(7), np.r_[4:7, 11:14]] + [np.arange(7*i, 7*i+4) for i in range(self._numOfCamerasToCalibrate)]
+        data    = [np.ones(7), np.r_[-baseline, baseline]] + [2*optimParam[7*i:7*i+4] for i in range(self._numOfCamerasToCalibrate)]
+
+        return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(columns))), \
+            shape=(8+self._numOfCamerasToCalibrate, numOfParams))
+
+    def _residualsJacobian(self, optimParam):
+        from scipy import sparse
+        start = time.perf_counter()
+        P, dPdParam = self._projectionMatricesDers(optimParam)
+        F = utils.calcFundamentalMatrices(P, self._cameraPairs)
+        _, drdF = utils.calcEpipolarResiduals(self._residualM1, F, self._residualM0, self._residualPairs, Ders=True)
+        drdF = np.reshape(drdF * self._residualWeights[:,None,None], (-1, 9))
+
+        # dF/dParam for both cameras of each pair, (M,9,7)
+        dFdPi, dFdPj = utils.calcFundamentalMatricesJacobian(P, self._cameraPairs)
+        dFdParamI = np.einsum('krcab,kpab->krcp', dFdPi, dPdParam[self._cameraPairs[:,0]]).reshape(-1, 9, 7)
+        dFdParamJ = np.einsum('krcab,kpab->krcp', dFdPj, dPdParam[self._cameraPairs[:,1]]).reshape(-1, 9, 7)
+
+        data = np.zeros((len(self._residualPairs), 14))
+        for k in range(len(self._cameraPairs)):
+            rows = slice(self._residualPtr[k], self._residualPtr[k+1])
+            data[rows,0:7]  = np.matmul(drdF[rows], dFdParamI[k])
+            data[rows,7:14] = np.matmul(drdF[rows], dFdParamJ[k])
+
+        numOfResiduals = len(self._residualPairs)
+        epipolar = sparse.csr_matrix((data.flatten(), self._residualColumns, np.arange(0, 14*numOfResiduals+1, 14)), \
+            shape=(numOfResiduals, len(self._optimParam)))
+        jacobian = sparse.vstack([epipolar, self._gaugeResidualsJacobian(optimParam)], format='csr')
+        if self._tracer is not None: self._traceEvaluation('jacobian', start)
+        return jacobian
+
+    def _minFunctionExtrinsicDers(self, optimParam):
+        # Identical params (e.g. repeated by line searches) are served from the memo of recent evaluations
+        start = time.perf_counter()
+        memoized = self._memo.lookup(optimParam, ders=True)
+        if memoized is not None:
+            self._error, grad = memoized
+            if self._tracer is not None: self._traceEvaluation('objective and gradient', start, error=self._error, \
+                gradient_norm=float(np.linalg.norm(grad)), memoized=True)
+            return self._error, grad.copy()
+
+        P, dPdParam = self._projectionMatricesDers(optimParam, Out=(self._workspace.P, self._workspace.dPdParam))
+
+        er, self._pointErrors, dP = self._targetErrorAllCamDers(optimParam, P)
+        self._error = er
+
+        grad = self._workspace.grad
+        np.einsum('npab,nab->np', dPdParam, dP, out=grad.reshape(-1, 7))
+        self._memo.store(optimParam, er, grad)
+        if self._tracer is not None: self._traceEvaluation('objective and gradient', start, error=er, gradient_norm=float(np.linalg.norm(grad)))
+
+        # Solvers keep returned gradients, a copy of the 7 params per camera leaves the buffers to the next evaluation
+        return er, grad.copy()
+
+    def _traceEvaluation(self, event, start, **fields):
+        self._tracer.record(event, duration=time.perf_counter() - start, points=self._numOfActivePoints, \
+            pairs=self._numOfActivePairs, entries=int(self._pairPtr[-1]), **fields)
+
+    def _projectionMatrices(self, optimParam):
+        return utils.calcProjectionMatrices(self.K, optimParam)
+
+    def _projectionMatricesDers(self, optimParam, Out=None):
+        return utils.calcProjectionMatricesDers(self.K, optimParam, Out=Out)
     
-    def _targetErrorAllCam(self, P):
-        e = 0
-        k = 0
-        er = 0
-        point_err = np.zeros((self._numberOfReferencePoints, self._numOfCamerasToCalibrate*self._numOfCamerasToCalibrate-self._numOfCamerasToCalibrate))
-        
-        for i in range(self._numOfCamerasToCalibrate):
-            for j in range(i+1,self._numOfCamerasToCalibrate):
-                if i is not j:
-                    F = utils.calcFundamentalMatrix(P[j,:,:], P[i,:,:])
-                    er, point_err[:,k:k+1] = \
-                        utils.calcFundamentalMatrixGeometricMean(
-                            self._usedReferencePoints[i,:,:], 
-                            F,
-                            self._usedReferencePoints[j,:,:]) 
-                    e = e + er
-                    k = k + 1
-
-        e = e / k
-        
+    def _targetErrorAllCam(self, optimParam, P):
+        if self._objective == 'reprojection':
+            cam_err, _, _, _ = utils.calcReprojectionErrors(P, self._referenceXY, self._referenceVisible, self._triangulatedPointIds, \
+                Ders=False, Loss=self._loss, LossScale=self._lossScale)
+            return (np.mean(cam_err), None)
+
+        pair_err, point_err, _ = self._calcEpipolarErrors(optimParam, P, Ders=False)
+        e = np.sum(pair_err) / len(self._cameraPairs)
+
         return (e, point_err)
 
-    def _pointCondition(self, cam, p):
-         return \
-            self._usedReferencePoints[cam][p][0]    == 0 or \
-            self._usedReferencePoints[cam][p][1]    == 0
+    def _targetErrorAllCamDers(self, optimParam, P):
+        if self._objective == 'reprojection':
+            cam_err, _, _, dP = utils.calcReprojectionErrors(P, self._referenceXY, self._referenceVisible, self._triangulatedPointIds, \
+                Ders=True, Loss=self._loss, LossScale=self._lossScale)
+            return (np.mean(cam_err), None, dP)
 
-    def _projectionMatrix(self, K, E):
-        return np.matmul(K,E)
-    
-    def _extrinsicMatrix(self, TranslationV, RotationM):
-        E           = np.eye(4)
-        E[0:3,0:3]  = RotationM
-        E[0:3,3]    = -1 * np.matmul(RotationM, TranslationV)
+        pair_err, point_err, dF = self._calcEpipolarErrors(optimParam, P, Ders=True)
+        e = np.sum(pair_err) / len(self._cameraPairs)
 
-        return E
-        
-    def _extrinsicMatrixDers(self, TranslationV, RotationM):
-        E           = np.eye(4)
-        E[0:3, 0:3] = RotationM
-        E[0:3, 3]   = np.transpose(TranslationV)
-        
-        return E
\ No newline at end of file
+        dP = utils.calcFundamentalMatricesDers(P, self._cameraPairs, dF, Out=self._workspace.dP)
+        dP /= len(self._cameraPairs)
+
+        return (e, point_err, dP)
+
+    def _calcEpipolarErrors(self, optimParam, P, Ders):
+        # In-process evaluations write into the buffers of the workspace, results are valid until the next evaluation
+        if self._workerPool is not None:
+            self._workspace.lastParam[:] = optimParam
+            return self._workerPool.calcEpipolarErrors(optimParam, Ders=Ders)
+        F = utils.calcFundamentalMatrices(P, self._cameraPairs, Out=self._workspace.F)
+        if self._chunkSize > 0:
+            return self._calcEpipolarErrorsChunked(F, Ders)
+        self._workspace.lastParam[:] = optimParam
+        return utils.calcEpipolarErrors(self._referenceXY, F, self._cameraPairs, self._pairPtr, self._pairPointIds, \
+            Ders=Ders, Backend=self._backend, Loss=self._loss, LossScale=self._lossScale, \
+            Out=self._workspace.epipolarOutputs(len(self._pairPointIds)), Scratch=self._workspace.scratch)
+
+    def _calcEpipolarErrorsChunked(self, F, Ders):
+        # Per-pair means accumulated over chunks of points weighted by their co-visible points, memory is bounded
+        # by the chunk size and distances of single points are not kept
+        pairSums = np.zeros(len(self._cameraPairs))
+        dFSums = np.zeros((len(self._cameraPairs), 3, 3)) if Ders else None
+        for pairPtr, pairPointIds in self._chunkCoVisibilityIndices():
+            pair_err, _, dF = utils.calcEpipolarErrors(self._referenceXY, F, self._cameraPairs, pairPtr, pairPointIds, \
+                Ders=Ders, Backend=self._backend, Loss=self._loss, LossScale=self._lossScale)
+            numOfPoints = np.diff(pairPtr)
+            pairSums += pair_err * numOfPoints
+            if Ders: dFSums += dF * numOfPoints[:, None, None]
+
+        numOfPoints = np.maximum(np.diff(self._pairPtr), 1)
+        return pairSums / numOfPoints, None, dFSums / numOfPoints[:, None, None] if Ders else None
+
+    def _writeTrajectory(self, path, optimParam) -> bool:
+        # Triangulated reference points (one row per point, NaN where seen by less than two cameras) with the number
+        # of cameras and the mean reprojection distance over them
+        visible = np.unpackbits(self._referenceVisibility, axis=1, count=self._numberOfReferencePoints).astype(bool)
+        pointIds = np.flatnonzero(np.sum(visible, axis=0) >= 2)
+        P = self._projectionMatrices(optimParam)
+        _, point_err, X, _ = utils.calcReprojectionErrors(P, self._referenceXY, visible, pointIds)
+
+        trajectory = np.full((self._numberOfReferencePoints, 5), np.nan)
+        trajectory[:, 3] = np.sum(visible, axis=0)
+        trajectory[pointIds, 0:3] = X
+        trajectory[pointIds, 4] = np.nanmean(point_err, axis=0)
+        np.savetxt(path, trajectory, fmt=['%.6f', '%.6f', '%.6f', '%d', '%.6f'], delimiter='\t', header='X\tY\tZ\tcameras\tmean reprojection error')
+        print(f'Saving trajectory of {len(pointIds)} triangulated points to {path}.')
+        return True
+
+    def _pointCondition(self, XY):
+        # Points on frame boundaries (of cameras with positive x coordinate)
+        return (XY[:,:,0] > 0) & ((XY[:,:,0] == 0) | (XY[:,:,1] == 0))
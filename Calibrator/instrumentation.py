@@ -0,0 +1,30 @@
+import json
+import time
+
+# ===================================================================================================
+# Trace of calibration events
+# ===================================================================================================
+class TraceWriter(object):
+    # Records calibration events (objective evaluations, rejections, global iterations) as dicts. Every record
+    # gets the event name and a timestamp, is appended to a JSONL file and passed to the optional callback.
+    # A new trace replaces the file, an appended one (e.g. of a resumed calibration) continues it.
+    def __init__(self, path=None, callback=None, append=False) -> None:
+        self._file = open(path, 'a' if append else 'w') if path is not None else None
+        self._callback = callback
+        return
+
+    def record(self, event, **fields) -> None:
+        record = {'event': event, 'timestamp': time.time()}
+        record.update(fields)
+        if self._file is not None:
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+        if self._callback is not None:
+            self._callback(record)
+        return
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return
@@ -0,0 +1,186 @@
+import io
+import numpy as np
+
+# ===================================================================================================
+# Binary marker positions store
+# ===================================================================================================
+# Header of 64 bytes (magic, number of cameras, number of points) followed by float32 x/y of all points of
+# camera 0, 1, ... (N,P,2) and uint8 visibility flags (N,P). Columns of one camera are contiguous, so
+# a memmap reads only the pages of the points and cameras actually used.
+STORE_MAGIC = b'MRKPOS01'
+STORE_HEADER_SIZE = 64
+
+def _storeLayout(numOfCams, numOfPoints):
+    xyOffset = STORE_HEADER_SIZE
+    visibilityOffset = xyOffset + numOfCams * numOfPoints * 2 * 4
+    return xyOffset, visibilityOffset, visibilityOffset + numOfCams * numOfPoints
+
+def createMarkerStore(path, numOfCams, numOfPoints):
+    # New store of given size, returns writable memmaps of coordinates (N,P,2) and visibility flags (N,P)
+    header = np.zeros(STORE_HEADER_SIZE, dtype=np.uint8)
+    header[0:8] = np.frombuffer(STORE_MAGIC, dtype=np.uint8)
+    header[8:16] = np.frombuffer(np.array([numOfCams, numOfPoints], dtype='<u4').tobytes(), dtype=np.uint8)
+    xyOffset, visibilityOffset, size = _storeLayout(numOfCams, numOfPoints)
+    with open(path, 'wb') as f:
+        f.write(header.tobytes())
+        f.truncate(size)
+    return openMarkerStore(path, mode='r+')
+
+def isMarkerStore(path):
+    with open(path, 'rb') as f:
+        return f.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+def openMarkerStore(path, mode='r'):
+    # Memmaps of coordinates (N,P,2) float32 and visibility flags (N,P) uint8 of a store
+    with open(path, 'rb') as f:
+        header = f.read(STORE_HEADER_SIZE)
+    assert header[0:8] == STORE_MAGIC, f'{path} is not a marker positions store'
+    numOfCams, numOfPoints = (int(n) for n in np.frombuffer(header[8:16], dtype='<u4'))
+    xyOffset, visibilityOffset, _ = _storeLayout(numOfCams, numOfPoints)
+    XY = np.memmap(path, dtype='<f4', mode=mode, offset=xyOffset, shape=(numOfCams, numOfPoints, 2))
+    visibility = np.memmap(path, dtype=np.uint8, mode=mode, offset=visibilityOffset, shape=(numOfCams, numOfPoints))
+    return XY, visibility
+
+def writeMarkerStore(path, XY, visibility):
+    XYStore, visibilityStore = createMarkerStore(path, XY.shape[0], XY.shape[1])
+    XYStore[:] = XY
+    visibilityStore[:] = visibility
+    XYStore.flush()
+    visibilityStore.flush()
+    return True
+
+def convertTextToStore(textPath, storePath, numOfCams):
+    # Rows are counted first, then chunks of parsed rows are written into the store
+    with open(textPath, 'rb') as f:
+        numOfPoints = sum(1 for line in f if line.strip())
+
+    XY, visibility = createMarkerStore(storePath, numOfCams, numOfPoints)
+    row = 0
+    for XYChunk, visibilityChunk in iterMarkerPositions(textPath, numOfCams):
+        XY[:, row:row+XYChunk.shape[1]] = XYChunk
+        visibility[:, row:row+XYChunk.shape[1]] = visibilityChunk
+        row += XYChunk.shape[1]
+    XY.flush()
+    visibility.flush()
+    return row
+
+# ===================================================================================================
+# Tab-separated marker positions
+# ===================================================================================================
+# One row per frame with x, y and visibility flag (0/1) of every camera, as written by the marker tracker.
+# Coordinates of invisible markers are -1.
+TEXT_CHUNK_BYTES = 1 << 24
+TEXT_CHUNK_ROWS = 1 << 14
+
+def markerArraysFromRows(rows, numOfCams, dtype=np.float32):
+    # Coordinates (N,P,2) of dtype, float32 by default, and visibility flags (N,P) uint8 of rows (P,3N) of the text format
+    rows = np.asarray(rows).reshape(-1, numOfCams, 3)
+    return np.ascontiguousarray(rows[:, :, 0:2].transpose(1, 0, 2), dtype=dtype), \
+        np.ascontiguousarray(rows[:, :, 2].T, dtype=np.uint8)
+
+def _parseRows(path, block, numOfCams, firstRow):
+    # Block of whole lines parsed at once by the C parser of loadtxt, which also checks that all lines have
+    # the same number of columns, so validating the columns of the result validates every row
+    try:
+        values = np.loadtxt(io.BytesIO(block), delimiter='\t', ndmin=2)
+    except ValueError as error:
+        raise ValueError(f'{path}: rows after {firstRow}: {error}') from None
+    if values.shape[1] != 3 * numOfCams:
+        raise ValueError(f'{path}: rows after {firstRow} have {values.shape[1]} columns, expected {3 * numOfCams} ({numOfCams} cameras)')
+    return markerArraysFromRows(values, numOfCams)
+
+def _formatRows(XY, visibility):
+    # Text of rows of the given points: every field is written right-aligned into a fixed-width character matrix
+    # (sign, integer digits, point, 3 decimals, separator; one row per character position) and unused characters
+    # are dropped by one boolean mask. Coordinates keep the decimals (%.3f of rounded integer thousandths),
+    # visibility flags don't (%d).
+    numOfCams, numOfRows = visibility.shape
+    if not np.all(np.isfinite(XY)):
+        raise ValueError('Marker coordinates must be finite')
+    values = np.empty((numOfRows, numOfCams, 3))
+    values[:, :, 0:2] = np.transpose(XY, (1, 0, 2))
+    values[:, :, 2] = np.transpose(visibility)
+    values = values.ravel()
+    isCoordinate = np.tile([True, True, False], numOfRows * numOfCams)
+
+    negative = values < 0
+    scaled = np.rint(np.abs(values) * 1000).astype(np.int64)
+    maxScaled = int(np.max(scaled, initial=0))
+    if maxScaled < 2**31: scaled = scaled.astype(np.int32)
+    numOfDigits = len(str(maxScaled // 1000))
+
+    # Digits from the last one, 32-bit x - (x // 10) * 10 is much faster than x % 10
+    chars = np.empty((numOfDigits + 6, len(values)), dtype=np.uint8)
+    keep = np.ones(chars.shape, dtype=bool)
+    chars[0] = ord('-')
+    keep[0] = negative
+    chars[numOfDigits+1] = ord('.')
+    for position in [numOfDigits + 4, numOfDigits + 3, numOfDigits + 2] + list(range(numOfDigits, 0, -1)):
+        quotient = scaled // 10
+        chars[position] = scaled - quotient * 10 + ord('0')
+        if position < numOfDigits: keep[position] = scaled > 0
+        scaled = quotient
+    keep[numOfDigits+1:numOfDigits+5] = isCoordinate
+    chars[numOfDigits+5] = ord('\t')
+    chars[numOfDigits+5, 3 * numOfCams - 1::3 * numOfCams] = ord('\n')
+    return chars.T[keep.T].tobytes()
+
+def iterMarkerPositions(path, numOfCams, chunkBytes=TEXT_CHUNK_BYTES):
+    # Coordinates (N,rows,2) and visibility flags (N,rows) of consecutive chunks of rows of a text file,
+    # chunks are cut at the last newline and the rest is carried over to the next chunk
+    row, rest = 0, b''
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunkBytes)
+            block = rest + data
+            if len(data) == 0:
+                if len(block.strip()) == 0: break
+                block += b'\n'
+            end = block.rfind(b'\n') + 1
+            block, rest = block[:end], block[end:]
+            if end == 0: continue
+            XY, visibility = _parseRows(path, block, numOfCams, row)
+            row += XY.shape[1]
+            if XY.shape[1] > 0: yield XY, visibility
+            if len(data) == 0: break
+    return
+
+def readMarkerPositions(path, numOfCams):
+    # Coordinates (N,P,2) float32 and visibility flags (N,P) uint8 of all cameras, memory-mapped for binary stores
+    if isMarkerStore(path):
+        XY, visibility = openMarkerStore(path)
+        if XY.shape[0] != numOfCams:
+            raise ValueError(f'{path}: store of {XY.shape[0]} cameras, expected {numOfCams}')
+        return XY, visibility
+
+    chunks = list(iterMarkerPositions(path, numOfCams))
+    if len(chunks) == 0:
+        return np.zeros((numOfCams, 0, 2), dtype=np.float32), np.zeros((numOfCams, 0), dtype=np.uint8)
+    return np.concatenate([XY for XY, _ in chunks], axis=1), np.concatenate([visibility for _, visibility in chunks], axis=1)
+
+def writeMarkerPositions(path, XY, visibility, chunkRows=TEXT_CHUNK_ROWS):
+    # Text format of the marker tracker (x and y with 3 decimals, visibility flag), written in chunks of rows
+    if path.endswith('.bin'):
+        return writeMarkerStore(path, XY, visibility)
+
+    numOfCams, numOfPoints = visibility.shape
+    with open(path, 'wb') as f:
+        for begin in range(0, numOfPoints, chunkRows):
+            f.write(_formatRows(XY[:, begin:begin + chunkRows], visibility[:, begin:begin + chunkRows]))
+    return True
+
+if __name__ == '__main__':
+    import argparse
+    argParser = argparse.ArgumentParser(prog="markers.py", description="Converts marker positions between txt files and binary stores (.bin)")
+    argParser.add_argument('-ncams',    type=int, required=True, help="Number of all cameras")
+    argParser.add_argument('-i',        type=str, required=True, help="Input marker positions (txt or binary store)")
+    argParser.add_argument('-o',        type=str, required=True, help="Output marker positions, a binary store if it ends with .bin")
+    args = argParser.parse_args()
+
+    if args.o.endswith('.bin') and not isMarkerStore(args.i):
+        numOfPoints = convertTextToStore(args.i, args.o, args.ncams)
+    else:
+        XY, visibility = readMarkerPositions(args.i, args.ncams)
+        writeMarkerPositions(args.o, XY, visibility)
+        numOfPoints = XY.shape[1]
+    print(f'Saving {numOfPoints} marker positions of {args.ncams} cameras to {args.o}.')
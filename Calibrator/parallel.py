@@ -0,0 +1,209 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import utils
+
+# ===================================================================================================
+# Worker side
+# ===================================================================================================
+_worker = {}
+
+def _attachArray(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    _worker.setdefault('shms', []).append(shm)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _initWorker(arrays, K, cameraPairs, backend, loss, lossScale):
+    # Attach once to the reference points, co-visibility index and per-point errors published by the main process
+    if utils.NUMBA_AVAILABLE:
+        import numba
+        numba.set_num_threads(1)
+
+    for key, (name, shape, dtype) in arrays.items():
+        _worker[key] = _attachArray(name, shape, dtype)
+    _worker['K']         = K
+    _worker['pairs']     = cameraPairs
+    _worker['backend']   = backend
+    _worker['loss']      = loss
+    _worker['lossScale'] = lossScale
+
+def _evaluateChunk(task):
+    optimParam, start, stop, ders = task
+    pairs = _worker['pairs'][start:stop]
+    pairPtr = _worker['pairPtr'][start:stop+1]
+
+    P = utils.calcProjectionMatrices(_worker['K'], optimParam)
+    F = utils.calcFundamentalMatrices(P, pairs)
+    pair_err, point_err, dF = utils.calcEpipolarErrors(_worker['XY'], F, pairs, pairPtr, _worker['pairPointIds'], Ders=ders, \
+        Backend=_worker['backend'], Loss=_worker['loss'], LossScale=_worker['lossScale'])
+
+    _worker['errors'][pairPtr[0]:pairPtr[-1]] = point_err
+    return pair_err, (dF if ders else None)
+
+# ===================================================================================================
+# Main process side
+# ===================================================================================================
+class PairWorkerPool(object):
+    # Persistent pool of processes evaluating contiguous chunks of camera pairs. Reference points, the
+    # co-visibility index and per-point errors live in shared memory, only the params vector is sent on each evaluation.
+    def __init__(self, numOfWorkers, referenceXY, pairPtr, pairPointIds, K, cameraPairs, backend, loss='none', lossScale=1.0) -> None:
+        self._numOfWorkers = numOfWorkers
+        self._cameraPairs  = cameraPairs
+
+        # Rejections only remove entries, so the initial index bounds the size of the shared buffers
+        self._shms, self._arrays, arrays = [], {}, {}
+        for key, shape, dtype in [('XY', referenceXY.shape, np.float32), ('pairPtr', pairPtr.shape, np.int64), \
+                                  ('pairPointIds', pairPointIds.shape, np.int32), ('errors', pairPointIds.shape, np.float64)]:
+            shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+            self._shms.append(shm)
+            self._arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            arrays[key] = (shm.name, shape, dtype)
+        self._arrays['XY'][:] = referenceXY
+        self.updateIndex(pairPtr, pairPointIds)
+
+        bounds = np.linspace(0, len(cameraPairs), numOfWorkers+1).astype(int)
+        self._chunks = [(bounds[w], bounds[w+1]) for w in range(numOfWorkers) if bounds[w] < bounds[w+1]]
+
+        # Spawn keeps workers independent of threads (numba, BLAS) already running in this process
+        self._pool = mp.get_context('spawn').Pool(numOfWorkers, initializer=_initWorker, initargs=(
+            arrays, K, cameraPairs, backend, loss, lossScale))
+        return
+
+    def updateIndex(self, pairPtr, pairPointIds) -> None:
+        # Publish the co-visibility index rebuilt after rejection, workers read it on every evaluation
+        self._arrays['pairPtr'][:] = pairPtr
+        self._arrays['pairPointIds'][:len(pairPointIds)] = pairPointIds
+        return
+
+    def calcEpipolarErrors(self, optimParam, Ders=False):
+        # Same outputs as utils.calcEpipolarErrors for all camera pairs, per-point errors stay in shared memory
+        optimParam = np.asarray(optimParam, dtype=np.float64)
+        results = self._pool.map(_evaluateChunk, [(optimParam, start, stop, Ders) for start, stop in self._chunks], chunksize=1)
+
+        pair_err = np.concatenate([r[0] for r in results])
+        dF = np.concatenate([r[1] for r in results]) if Ders else None
+        return pair_err, self._arrays['errors'][:self._arrays['pairPtr'][-1]], dF
+
+    def close(self) -> None:
+        self._pool.close()
+        self._pool.join()
+        self._arrays.clear()
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        return
+
+# ===================================================================================================
+# Multi-start
+# ===================================================================================================
+class _StartStopped(Exception):
+    pass
+
+def _initStartWorker(calibrator, bestErrors, numOfThreads, stopRatio, minEvaluations):
+    if utils.NUMBA_AVAILABLE:
+        import numba
+        numba.set_num_threads(numOfThreads)
+
+    _worker['calibrator']     = calibrator
+    _worker['bestErrors']     = bestErrors
+    _worker['stopRatio']      = stopRatio
+    _worker['minEvaluations'] = minEvaluations
+
+def _runStart(task):
+    startId, optimParam = task
+    bestErrors = _worker['bestErrors']
+    state = {'x': np.array(optimParam), 'f': np.inf, 'nfev': 0}
+
+    def monitor(x, f):
+        state['nfev'] += 1
+        if f < state['f']:
+            state['x'], state['f'] = np.array(x), f
+            bestErrors[startId] = f
+        # Give up once this start clearly trails the best one
+        if state['nfev'] >= _worker['minEvaluations'] and state['f'] > _worker['stopRatio'] * min(bestErrors[:]):
+            raise _StartStopped()
+
+    try:
+        optimResult = _worker['calibrator'].minimize(optimParam, monitor)
+        return optimResult['x'], optimResult['fun'], state['nfev'], False
+    except _StartStopped:
+        return state['x'], state['f'], state['nfev'], True
+
+def runMultiStart(calibrator, starts, stopRatio=2.0, minEvaluations=50):
+    # Runs calibrator.minimize from all starts in a process pool,
+    # returns (solution, error, evaluations, stopped early) for each start
+    ctx = mp.get_context('spawn')
+    numOfProcesses = min(len(starts), mp.cpu_count())
+    numOfThreads = max(1, mp.cpu_count() // numOfProcesses)
+    bestErrors = ctx.Array('d', [np.inf]*len(starts), lock=False)
+
+    with ctx.Pool(numOfProcesses, initializer=_initStartWorker, initargs=(calibrator, bestErrors, numOfThreads, stopRatio, minEvaluations)) as pool:
+        results = pool.map(_runStart, list(enumerate(starts)), chunksize=1)
+    return results
+
+# ===================================================================================================
+# Partitioned calibration
+# ===================================================================================================
+def _initPartitionWorker(numOfThreads):
+    if utils.NUMBA_AVAILABLE:
+        import numba
+        numba.set_num_threads(numOfThreads)
+
+def _solvePartition(calibrator):
+    solution = np.asarray(calibrator._solve(), dtype=np.float64)
+    return solution, calibrator._minFunctionExtrinsic(solution)
+
+def runPartitions(calibrators):
+    # Solves the camera cluster problems in a process pool, returns (solution, error) for each cluster
+    ctx = mp.get_context('spawn')
+    numOfProcesses = min(len(calibrators), mp.cpu_count())
+    numOfThreads = max(1, mp.cpu_count() // numOfProcesses)
+
+    with ctx.Pool(numOfProcesses, initializer=_initPartitionWorker, initargs=(numOfThreads,)) as pool:
+        results = pool.map(_solvePartition, calibrators, chunksize=1)
+    return results
+
+# ===================================================================================================
+# Scaling measurement
+# ===================================================================================================
+def measureScaling(numOfCams, numOfPoints, workerCounts, evaluations=20, backend='auto'):
+    # Objective+gradient evaluations per second on a synthetic rig for the given numbers of workers
+    rng = np.random.default_rng(0)
+    K = np.full((numOfCams,4,4), np.eye(4))
+    K[:,0,0] = K[:,1,1] = 1000
+    K[:,0,2], K[:,1,2] = 960, 540
+    optimParam = np.zeros(7*numOfCams)
+    optimParam[3::7] = 1
+    optimParam[4::7] = np.arange(numOfCams)
+
+    XY = np.empty((numOfCams, numOfPoints, 2), dtype=np.float32)
+    XY[:,:,0] = rng.uniform(0, 1920, (numOfCams, numOfPoints))
+    XY[:,:,1] = rng.uniform(0, 1080, (numOfCams, numOfPoints))
+    visibility = np.packbits(rng.random((numOfCams, numOfPoints)) >= 0.3, axis=1)
+    cameraPairs = utils.getCameraPairs(numOfCams)
+    pairPtr, pairPointIds = utils.buildCoVisibilityIndex(visibility, numOfPoints, cameraPairs)
+
+    import time
+    results = {}
+    for numOfWorkers in workerCounts:
+        pool = PairWorkerPool(numOfWorkers, XY, pairPtr, pairPointIds, K, cameraPairs, backend)
+        pool.calcEpipolarErrors(optimParam, Ders=True)
+        start = time.perf_counter()
+        for _ in range(evaluations): pool.calcEpipolarErrors(optimParam, Ders=True)
+        results[numOfWorkers] = evaluations / (time.perf_counter() - start)
+        pool.close()
+    return results
+
+if __name__ == '__main__':
+    import argparse
+    argParser = argparse.ArgumentParser(prog="parallel.py", description="Scaling of the process-parallel objective")
+    argParser.add_argument('-ncams',    type=int, default=40,    help="Number of synthetic cameras")
+    argParser.add_argument('-npoints',  type=int, default=20000, help="Number of synthetic reference points")
+    argParser.add_argument('-workers',  type=int, nargs='+', default=[1, 2, 4, 8], help="Numbers of workers to measure")
+    args = argParser.parse_args()
+
+    results = measureScaling(args.ncams, args.npoints, args.workers)
+    print(f'{args.ncams} cameras, {args.npoints} points (cpu count {mp.cpu_count()})')
+    for numOfWorkers, evalsPerSec in results.items():
+        print(f'{numOfWorkers:3d} workers: {evalsPerSec:8.2f} evaluations/s, speedup {evalsPerSec/results[args.workers[0]]:5.2f}x')
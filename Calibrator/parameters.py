@@ -4,7 +4,6 @@ import json
 import datetime
 import enum
 import os
-from scipy.spatial.transform import Rotation
 
 import utils
 
@@ -53,6 +52,7 @@ class CameraParameters(object):
   def RotationV(self): return self._RotationV
   @RotationV.setter
   def RotationV(self, RotationV):
+    from scipy.spatial.transform import Rotation
     self._RotationV = RotationV
     self._RotationM = Rotation.from_euler('xyz', RotationV, degrees=True).as_matrix()
     self._RotationQ = Rotation.from_euler('xyz', RotationV, degrees=True).as_quat()
@@ -61,6 +61,7 @@ class CameraParameters(object):
   def RotationM(self): return self._RotationM
   @RotationM.setter
   def RotationM(self, RotationM):
+    from scipy.spatial.transform import Rotation
     self._RotationM = RotationM
     self._RotationV = Rotation.from_matrix(RotationM).as_euler('xyz', degrees=True)
     self._RotationQ = Rotation.from_matrix(RotationM).as_quat()
@@ -69,6 +70,7 @@ class CameraParameters(object):
   def RotationQ(self): return self._RotationQ
   @RotationQ.setter
   def RotationQ(self, RotationQ):
+    from scipy.spatial.transform import Rotation
     self._RotationQ = RotationQ
     self._RotationV = Rotation.from_quat(RotationQ).as_euler('xyz', degrees=True)
     self._RotationM = Rotation.from_quat(RotationQ).as_matrix()
@@ -129,6 +131,7 @@ class CameraParameters(object):
     self._PrinciplePointXY  = np.array(ContentJSON['Principle_point'],  dtype=np.float64  )
     self._DepthRange        = np.array(ContentJSON['Depth_range'    ],  dtype=np.float64)
  
+    from scipy.spatial.transform import Rotation
     self._RotationM = Rotation.from_euler('xyz', self._RotationV, degrees=True).as_matrix()
     self._RotationQ = Rotation.from_euler('xyz', self._RotationV, degrees=True).as_quat()
 
@@ -0,0 +1,118 @@
+import os
+import json
+import errno
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# ===================================================================================================
+# Cache of calibration results
+# ===================================================================================================
+# Sources whose changes invalidate cached results
+_SOURCES = ['calibrator.py', 'utils.py', 'parameters.py', 'parallel.py', 'markers.py', 'workspace.py']
+
+def _hashFile(hasher, path):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            hasher.update(block)
+
+def calcCacheKey(inputs, options):
+    # SHA-256 of the inputs (contents of files given by their paths or arrays held in memory), the options
+    # (a dict of JSON values) and the calibrator sources
+    hasher = hashlib.sha256()
+    for value in inputs:
+        if isinstance(value, np.ndarray):
+            hasher.update(f'\0array\0{value.dtype.str}{value.shape}\0'.encode())
+            hasher.update(memoryview(np.ascontiguousarray(value)).cast('B'))
+            continue
+        hasher.update(b'\0file\0')
+        if value is not None: _hashFile(hasher, value)
+    hasher.update(json.dumps(options, sort_keys=True).encode())
+    directory = os.path.dirname(os.path.realpath(__file__))
+    for source in _SOURCES:
+        _hashFile(hasher, os.path.join(directory, source))
+    return hasher.hexdigest()
+
+class ResultCache(object):
+    # Output files of calibrations stored under the key of their inputs, one directory per entry with the files
+    # named by their suffix after the output path stem. Least recently used entries are evicted once the total
+    # size exceeds maxBytes.
+    def __init__(self, directory, maxBytes) -> None:
+        self._directory = directory
+        self._maxBytes = maxBytes
+        os.makedirs(self._directory, exist_ok=True)
+        return
+
+    def restore(self, key, outputPath):
+        # Copies the stored files next to outputPath, returns their paths and the stored final error (None if not
+        # stored) or None on a miss (also when the entry is evicted by a concurrent run while it is read)
+        entry = os.path.join(self._directory, key)
+        manifestPath = os.path.join(entry, 'manifest.json')
+        stem = os.path.splitext(outputPath)[0]
+        restored = []
+        try:
+            with open(manifestPath) as f:
+                manifest = json.load(f)
+            suffixes = manifest['files']
+            for suffix in suffixes:
+                shutil.copyfile(os.path.join(entry, suffix), stem + suffix)
+                restored.append(stem + suffix)
+            os.utime(manifestPath)
+        except FileNotFoundError:
+            return None
+        return restored, manifest.get('error')
+
+    def store(self, key, outputPath, files, error=None) -> bool:
+        # Stores the given output files (paths starting with the stem of outputPath) and the final error of their
+        # calibration and evicts old entries.
+        # Every writer fills its own temporary directory that is renamed to the entry, when concurrent runs store
+        # the same key the first rename wins and the others keep its entry.
+        stem = os.path.splitext(outputPath)[0]
+        entry = os.path.join(self._directory, key)
+        temporary = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=self._directory)
+        try:
+            suffixes = []
+            for path in files:
+                assert path.startswith(stem), f'{path} is not an output of {outputPath}'
+                shutil.copyfile(path, os.path.join(temporary, path[len(stem):]))
+                suffixes.append(path[len(stem):])
+            with open(os.path.join(temporary, 'manifest.json'), 'w') as f:
+                json.dump({'files': suffixes, 'error': error}, f, indent=2)
+
+            try:
+                os.rename(temporary, entry)
+            except OSError as error:
+                # The entry of another writer (or one being evicted) is in place
+                if not isinstance(error, FileExistsError) and error.errno not in (errno.EEXIST, errno.ENOTEMPTY): raise
+        finally:
+            shutil.rmtree(temporary, ignore_errors=True)
+        self.evict(keep=key)
+        return True
+
+    def evict(self, keep=None) -> int:
+        # Removes least recently used entries (except keep) until the total size fits, returns the number of removed entries
+        entries = []
+        for key in os.listdir(self._directory):
+            # Temporary directories of other writers are skipped, entries may disappear under concurrent eviction
+            if key == keep or key.endswith('.tmp'): continue
+            manifestPath = os.path.join(self._directory, key, 'manifest.json')
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(os.path.join(self._directory, key)))
+                entries.append((os.path.getmtime(manifestPath), size, key))
+            except OSError:
+                continue
+
+        totalSize = sum(size for _, size, _ in entries)
+        if keep is not None and os.path.isdir(os.path.join(self._directory, keep)):
+            try:
+                totalSize += sum(entry.stat().st_size for entry in os.scandir(os.path.join(self._directory, keep)))
+            except OSError:
+                pass
+        removed = 0
+        for _, size, key in sorted(entries):
+            if totalSize <= self._maxBytes: break
+            shutil.rmtree(os.path.join(self._directory, key), ignore_errors=True)
+            totalSize -= size
+            removed += 1
+        return removed
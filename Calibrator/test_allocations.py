@@ -0,0 +1,91 @@
+import io
+import tempfile
+import unittest
+import contextlib
+import tracemalloc
+import numpy as np
+
+import benchmark
+import calibrator
+import utils
+
+# Objective and gradient evaluations write buffers of co-visible points into the workspace of the Calibrator.
+# What they still allocate (matrices of cameras and pairs, the copy of the returned gradient) must not grow
+# with the number of points. Run with: python -m unittest test_allocations
+NUM_OF_CAMS, NUM_OF_POINTS = 12, 1000
+BACKENDS = ['numba', 'threads', 'numpy'] if utils.NUMBA_AVAILABLE else ['numpy']
+
+def measureAllocations(app, evaluations=5):
+    # Largest peak of bytes traced by tracemalloc during one objective and gradient evaluation (at new params each time),
+    # above the bytes held before it. The first evaluation is not traced, it may compile kernels.
+    optimParam = np.array(app._optimParam, dtype=np.float64)
+    app._minFunctionExtrinsicDers(optimParam)
+    peak = 0
+    tracemalloc.start()
+    try:
+        for _ in range(evaluations):
+            optimParam[4::7] += 1e-9
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            app._minFunctionExtrinsicDers(optimParam)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+class EvaluationAllocationsTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._apps = []
+
+    def tearDown(self):
+        for app in self._apps: app.close()
+        self._directory.cleanup()
+
+    def _calibrator(self, numOfPoints, backend):
+        directory = tempfile.mkdtemp(dir=self._directory.name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = calibrator.Calibrator(benchmark.syntheticArgs(directory, NUM_OF_CAMS, numOfPoints, ['-backend', backend]))
+        self._apps.append(app)
+        return app
+
+    def test_allocations_do_not_grow_with_points(self):
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                small, large = self._calibrator(NUM_OF_POINTS, backend), self._calibrator(4 * NUM_OF_POINTS, backend)
+                added = int(large._pairPtr[-1] - small._pairPtr[-1])
+                self.assertGreater(added, 0)
+                growth = measureAllocations(large) - measureAllocations(small)
+                # A single float per co-visible point pair would add 8 bytes each
+                self.assertLess(growth / added, 1.0, f'{growth} bytes more for {added} more co-visible point pairs')
+
+    def test_workspace_buffers_are_reused(self):
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                app = self._calibrator(NUM_OF_POINTS, backend)
+                ws = app._workspace
+                buffers = [ws.P, ws.dPdParam, ws.F, ws.pairErrors, ws.dF, ws.dP, ws.grad]
+                optimParam = np.array(app._optimParam, dtype=np.float64)
+                for n in range(3):
+                    optimParam[4::7] += 1e-9
+                    _, grad = app._minFunctionExtrinsicDers(optimParam)
+                    self.assertIs(app._workspace, ws)
+                    self.assertTrue(all(a is b for a, b in zip(buffers, [ws.P, ws.dPdParam, ws.F, ws.pairErrors, ws.dF, ws.dP, ws.grad])))
+                    self.assertTrue(np.shares_memory(app._pointErrors, ws.epipolarOutputs(len(app._pairPointIds))[1]))
+                    # Returned gradients are kept by solvers, so they must not alias the workspace
+                    self.assertFalse(np.shares_memory(grad, ws.grad))
+                self.assertEqual(ws.scratch is not None, backend == 'numpy')
+
+    def test_repeated_params_are_memoized(self):
+        app = self._calibrator(NUM_OF_POINTS, BACKENDS[0])
+        optimParam = np.array(app._optimParam, dtype=np.float64)
+        error, grad = app._minFunctionExtrinsicDers(optimParam)
+        hits = app._memo.hits
+        memoizedError, memoizedGrad = app._minFunctionExtrinsicDers(optimParam.copy())
+        self.assertEqual(app._memo.hits, hits + 1)
+        self.assertEqual(memoizedError, error)
+        np.testing.assert_array_equal(memoizedGrad, grad)
+        self.assertEqual(app._minFunctionExtrinsic(optimParam), error)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import numpy as np
+
+import utils
+
+# Fundamental matrices and epipolar errors of all backends against a plain per-pair reference on a small random rig.
+# The numba kernel gives the same bits for any number of threads and the threads backend the same bits as the
+# numba kernel. Run with: python -m unittest test_backends
+NUM_OF_CAMS, NUM_OF_POINTS, LOSS_SCALE = 5, 300, 2.0
+BACKENDS = ['numba', 'threads', 'numpy'] if utils.NUMBA_AVAILABLE else ['numpy']
+
+def calcReferenceFundamentalMatrix(A, B):
+    # F[r,c] = (-1)**(r+c) * det of the rows of A without row c and the rows of B without row r
+    F = np.zeros((3,3))
+    for r in range(3):
+        for c in range(3):
+            F[r,c] = (-1)**(r+c) * np.linalg.det(np.concatenate([np.delete(A[0:3], c, axis=0), np.delete(B[0:3], r, axis=0)]))
+    return F
+
+def calcReferenceEpipolarErrors(XY, F, Pairs, Visible, Loss):
+    # Per-pair mean errors, distances of co-visible points and derivatives of the means over F, pair by pair
+    pair_err, point_err, dF = np.zeros(len(Pairs)), [], np.zeros((len(Pairs),3,3))
+    for k, (i, j) in enumerate(Pairs):
+        for n in np.flatnonzero(Visible[i] & Visible[j]):
+            m0, m1 = np.append(XY[j,n], 1.0).astype(np.float64), np.append(XY[i,n], 1.0).astype(np.float64)
+            l0 = F[k] @ m0
+            e, s = m1 @ l0, np.hypot(l0[0], l0[1])
+            d = abs(e) / s
+            if Loss == 'none':
+                rho, drho = d, 1.0
+            else:
+                z = (d / LOSS_SCALE)**2
+                rho, drho, _ = (float(value) for value in utils.calcRobustLoss(np.array(z), Loss))
+                rho, drho = 0.5 * LOSS_SCALE * rho, drho * d / LOSS_SCALE
+            point_err.append(d)
+            pair_err[k] += rho
+            dF[k] += drho * np.outer(np.sign(e) / s * m1 - abs(e) / s**3 * np.array([l0[0], l0[1], 0.0]), m0)
+        numOfPoints = np.sum(Visible[i] & Visible[j])
+        if numOfPoints > 0:
+            pair_err[k] /= numOfPoints
+            dF[k] /= numOfPoints
+    return pair_err, np.array(point_err), dF
+
+class EpipolarBackendsTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        K = np.full((NUM_OF_CAMS,4,4), np.eye(4))
+        K[:,0:3,0:3] = [[1000, 0, 960], [0, 1000, 540], [0, 0, 1]]
+        params = np.zeros((NUM_OF_CAMS,7))
+        params[:,0:4] = [1, 0, 0, 0] + rng.normal(0, 0.05, (NUM_OF_CAMS,4))
+        params[:,4] = np.arange(NUM_OF_CAMS) * 0.1
+        params[:,5:7] = rng.normal(0, 0.02, (NUM_OF_CAMS,2))
+        self._P = utils.calcProjectionMatrices(K, params.ravel())
+        self._Pairs = utils.getCameraPairs(NUM_OF_CAMS)
+        self._XY = rng.uniform(0, 1920, (NUM_OF_CAMS, NUM_OF_POINTS, 2)).astype(np.float32)
+        self._Visible = rng.uniform(size=(NUM_OF_CAMS, NUM_OF_POINTS)) < 0.7
+        # A camera without co-visible points
+        self._Visible[-1] = False
+        self._PairPtr, self._PairPointIds = utils.buildCoVisibilityIndex(np.packbits(self._Visible, axis=1), NUM_OF_POINTS, self._Pairs)
+        self._F = utils.calcFundamentalMatrices(self._P, self._Pairs)
+
+    def tearDown(self):
+        utils.setNumThreads(0)
+
+    def _calcEpipolarErrors(self, backend, loss, numOfThreads=0):
+        utils.setNumThreads(numOfThreads)
+        return utils.calcEpipolarErrors(self._XY, self._F, self._Pairs, self._PairPtr, self._PairPointIds, Ders=True, \
+            Backend=backend, Loss=loss, LossScale=LOSS_SCALE)
+
+    def test_fundamental_matrices_match_reference(self):
+        for k, (i, j) in enumerate(self._Pairs):
+            F = calcReferenceFundamentalMatrix(self._P[j], self._P[i])
+            np.testing.assert_allclose(self._F[k], F, rtol=1e-9, atol=1e-9 * np.abs(F).max())
+
+    def test_backends_match_reference(self):
+        for loss in utils.ROBUST_LOSSES:
+            reference = calcReferenceEpipolarErrors(self._XY, self._F, self._Pairs, self._Visible, loss)
+            for backend in BACKENDS:
+                with self.subTest(backend=backend, loss=loss):
+                    for result, expected in zip(self._calcEpipolarErrors(backend, loss), reference):
+                        np.testing.assert_allclose(result, expected, rtol=1e-9, atol=1e-12)
+
+    @unittest.skipUnless(utils.NUMBA_AVAILABLE, 'numba is not installed')
+    def test_numba_backends_are_bit_identical_across_threads(self):
+        for loss in utils.ROBUST_LOSSES:
+            serial = [np.array(result) for result in self._calcEpipolarErrors('numba', loss, numOfThreads=1)]
+            for backend in ['numba', 'threads']:
+                for numOfThreads in [1, 4]:
+                    with self.subTest(backend=backend, loss=loss, threads=numOfThreads):
+                        for result, expected in zip(self._calcEpipolarErrors(backend, loss, numOfThreads), serial):
+                            np.testing.assert_array_equal(result, expected)
+
+if __name__ == '__main__':
+    unittest.main()
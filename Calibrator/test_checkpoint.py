@@ -0,0 +1,65 @@
+import io
+import os
+import tempfile
+import unittest
+import contextlib
+import numpy as np
+
+import benchmark
+import calibrator
+import markers
+import parameters
+
+# Resuming from the checkpoint of a run returns its solution. Run with: python -m unittest test_checkpoint
+NUM_OF_CAMS, NUM_OF_POINTS = 6, 400
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        referencePointsPath, initCamParamsPath, _ = benchmark.writeSyntheticRig(self._directory.name, NUM_OF_CAMS, NUM_OF_POINTS)
+        self._XY, self._visibility = markers.readMarkerPositions(referencePointsPath, NUM_OF_CAMS)
+        self._initParams = parameters.SystemParameters(range(NUM_OF_CAMS))
+        self._initParams.readFrom(initCamParamsPath)
+        self._outputPath = os.path.join(self._directory.name, 'calibratedParams.json')
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def _calibrate(self, iterations=2, **options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return calibrator.calibrate(self._XY, self._visibility, self._initParams, iterations=iterations, \
+                outputPath=self._outputPath, **options)
+
+    def _assertSameResult(self, resumed, result):
+        self.assertEqual(resumed.error, result.error)
+        self.assertEqual(resumed.outputFiles, result.outputFiles)
+        for CamId in result.parameters.CameraIds:
+            np.testing.assert_array_equal(resumed.parameters.Params[CamId].RotationQ, result.parameters.Params[CamId].RotationQ)
+            np.testing.assert_array_equal(resumed.parameters.Params[CamId].TranslationV, result.parameters.Params[CamId].TranslationV)
+
+    def test_resume_finished_run(self):
+        result = self._calibrate(iterations=5)
+        self.assertLess(result.error, 10)
+        self.assertTrue(all(os.path.exists(path) for path in result.outputFiles))
+        self._assertSameResult(self._calibrate(iterations=5, resume=True), result)
+
+    def test_resume_after_last_iteration(self):
+        # A run stopped by its number of iterations before convergence is not finished, resuming it with the
+        # same number of iterations has nothing left to solve
+        result = self._calibrate(iterations=1)
+        self._assertSameResult(self._calibrate(iterations=1, resume=True), result)
+
+    def test_resume_with_other_options_or_inputs_fails(self):
+        self._calibrate(iterations=1)
+        with self.assertRaises(ValueError):
+            self._calibrate(iterations=1, resume=True, loss='huber')
+        self._XY = self._XY + 0.5
+        with self.assertRaises(ValueError):
+            self._calibrate(iterations=1, resume=True)
+
+    def test_resume_with_other_threads(self):
+        result = self._calibrate(iterations=1)
+        self._assertSameResult(self._calibrate(iterations=1, resume=True, threads=1), result)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import io
+import tempfile
+import unittest
+import contextlib
+
+import benchmark
+import calibrator
+import utils
+
+# The analytic gradient of the objective, which all solvers use, against central finite differences
+# (checkGradient, the -checkgrad mode of calibrateCameras.py). Run with: python -m unittest test_gradient
+NUM_OF_CAMS, NUM_OF_POINTS = 5, 300
+
+class GradientTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def _checkGradient(self, options):
+        directory = tempfile.mkdtemp(dir=self._directory.name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = calibrator.Calibrator(benchmark.syntheticArgs(directory, NUM_OF_CAMS, NUM_OF_POINTS, options))
+            try:
+                return app.checkGradient()
+            finally:
+                app.close()
+
+    def test_epipolar_gradient(self):
+        for loss in utils.ROBUST_LOSSES:
+            with self.subTest(loss=loss):
+                self.assertTrue(self._checkGradient(['-objective', 'epipolar', '-loss', loss, '-lossscale', '2.0']))
+
+    def test_reprojection_gradient(self):
+        self.assertTrue(self._checkGradient(['-objective', 'reprojection']))
+
+if __name__ == '__main__':
+    unittest.main()
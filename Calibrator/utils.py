@@ -1,16 +1,23 @@
 import numpy as np
 import itertools
 import math
+import time
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 try:
   import numba
   my_jit = numba.jit
+  my_prange = numba.prange
+  NUMBA_AVAILABLE = True
 except:
   def _noop_jit(f=None, *args, **kwargs):
     """ returns function unmodified, discarding decorator args"""
     if f is None: return lambda x: x
     return f
   my_jit = _noop_jit
+  my_prange = range
+  NUMBA_AVAILABLE = False
 
 #==============================================================================================================================================================
 # CamUtils
@@ -110,39 +117,653 @@ def VSRStoJSON(TranslationV, RotationM):
   
   return Position, EulerAngles
 
-@my_jit(nopython=True)
-def calcFundamentalMatrixGeometricMean(m1, F, m0):
-    d1, d2 = m0.shape
-    error = 0
-    point_err = -1*np.ones((d1, 1))
-    numofpoints = 0
-    Ft = np.transpose(F)
-    
-    for n in range(d1):
-        if (m0[n,2] == 1) and (m1[n,2] == 1):
-            l0 = F.dot(np.transpose(m0[n,0:3]))
-            l1 = (Ft).dot(np.transpose(m1[n,0:3]))
-            e = (m1[n,0:3]).dot(l0)
-            f = (m0[n,0:3]).dot(l1)
-            point_err[n,0] = (abs(e)*(1/np.sqrt(l0[0]*l0[0]+l0[1]*l0[1])))
-            
-            error = error + point_err[n,0]
-            numofpoints = numofpoints + 1
-
-    if numofpoints > 0: error = error / numofpoints          
-    return (error, point_err)
-  
-def calcFundamentalMatrix(A, B):    
-    F = np.eye(3)
-    F[0,0]=(-1)**(1+1)*np.linalg.det([A[1,:],A[2,:],B[1,:],B[2,:]])
-    F[0,1]=(-1)**(2+1)*np.linalg.det([A[0,:],A[2,:],B[1,:],B[2,:]])
-    F[0,2]=(-1)**(3+1)*np.linalg.det([A[0,:],A[1,:],B[1,:],B[2,:]])
-    F[1,0]=(-1)**(1+2)*np.linalg.det([A[1,:],A[2,:],B[0,:],B[2,:]])
-    F[1,1]=(-1)**(2+2)*np.linalg.det([A[0,:],A[2,:],B[0,:],B[2,:]])
-    F[1,2]=(-1)**(3+2)*np.linalg.det([A[0,:],A[1,:],B[0,:],B[2,:]])
-    F[2,0]=(-1)**(1+3)*np.linalg.det([A[1,:],A[2,:],B[0,:],B[1,:]])
-    F[2,1]=(-1)**(2+3)*np.linalg.det([A[0,:],A[2,:],B[0,:],B[1,:]])
-    F[2,2]=(-1)**(3+3)*np.linalg.det([A[0,:],A[1,:],B[0,:],B[1,:]])
-    return F
+#==============================================================================================================================================================
+# Batched fundamental matrices
+#==============================================================================================================================================================
+# The fundamental matrix of cameras A and B has F[r,c] = (-1)**(r+c) * det of the rows of A without row c and the rows of
+# B without row r, a determinant of two rows of A with two rows of B. Writing each row pair as
+# a bivector (6 Pluecker coordinates), such a determinant is a bilinear form LA^T * _PLUECKER_DUAL * LB.
+_PLUECKER_IDX  = np.array([[0,1], [0,2], [0,3], [1,2], [1,3], [2,3]])
+_PLUECKER_DUAL = np.fliplr(np.diag([1.0, -1.0, 1.0, 1.0, -1.0, 1.0]))
+_SKIPPED_ROWS  = np.array([[1,2], [0,2], [0,1]])
+_COFACTOR_SIGN = np.array([[1.0, -1.0, 1.0], [-1.0, 1.0, -1.0], [1.0, -1.0, 1.0]])
+
+def getCameraPairs(NumCams):
+  # Camera pairs (i, j), i < j, in the order of the i/j loops of Calibrator
+  I, J = np.triu_indices(NumCams, 1)
+  return np.stack([I, J], axis=1)
+
+#==============================================================================================================================================================
+# Camera pair selection
+#==============================================================================================================================================================
+PAIR_POLICIES = ['all', 'covisible', 'nearest', 'list']
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+def countCoVisiblePoints(Visibility, Pairs):
+  # Number of points visible in both cameras of each pair, Visibility as in buildCoVisibilityIndex
+  return np.array([_POPCOUNT[Visibility[i] & Visibility[j]].sum() for i, j in Pairs], dtype=np.int64)
+
+def selectNearestCameraPairs(Positions, NumNearest):
+  # Pairs of every camera with its NumNearest nearest cameras, Positions: (N,3) camera centres
+  Distances = np.linalg.norm(Positions[:,None,:] - Positions[None,:,:], axis=2)
+  np.fill_diagonal(Distances, np.inf)
+  Nearest = np.argsort(Distances, axis=1, kind='stable')[:, :min(NumNearest, len(Positions)-1)]
+  I = np.repeat(np.arange(len(Positions)), Nearest.shape[1])
+  return sortCameraPairs(np.stack([I, Nearest.ravel()], axis=1))
+
+def sortCameraPairs(Pairs):
+  # Unique pairs (i, j), i < j, in the order of getCameraPairs
+  Pairs = np.sort(np.asarray(Pairs, dtype=np.int64).reshape(-1, 2), axis=1)
+  Pairs = Pairs[Pairs[:,0] != Pairs[:,1]]
+  return np.unique(Pairs, axis=0)
+
+def countConnectedComponents(NumCams, Pairs):
+  # Number of connected components of the camera graph with edges Pairs
+  Labels = np.arange(NumCams)
+  for _ in range(NumCams):
+    Merged = Labels.copy()
+    np.minimum.at(Merged, Pairs[:,0], Labels[Pairs[:,1]])
+    np.minimum.at(Merged, Pairs[:,1], Labels[Pairs[:,0]])
+    Merged = Merged[Merged]
+    if np.array_equal(Merged, Labels): break
+    Labels = Merged
+  return len(np.unique(Labels))
+
+#==============================================================================================================================================================
+# Point subsampling
+#==============================================================================================================================================================
+def selectStratifiedPoints(XY, Visibility, NumPoints, Fraction, GridSize=8, Seed=0):
+  # Subset of about Fraction of the visible points of every camera, spread evenly over a GridSize x GridSize grid
+  # of its image area: cells are visited round-robin, so sparse regions keep all their points. Returns (P,) bool mask
+  Rng = np.random.default_rng(Seed)
+  Selected = np.zeros(NumPoints, dtype=bool)
+  for Cam in range(len(XY)):
+    Ids = np.flatnonzero(np.unpackbits(Visibility[Cam], count=NumPoints))
+    if len(Ids) == 0: continue
+    CamXY = XY[Cam, Ids].astype(np.float64)
+    Lo, Hi = CamXY.min(axis=0), CamXY.max(axis=0)
+    Cells = np.minimum((GridSize * (CamXY - Lo) / np.maximum(Hi - Lo, 1e-9)).astype(np.int64), GridSize-1)
+    Cells = Cells[:,0] * GridSize + Cells[:,1]
+
+    # Rank of each point within its cell, points already selected for previous cameras first and the rest in
+    # random order, then take ranks 0, 1, ... of all cells
+    Random = Rng.random(len(Ids))
+    Order = np.lexsort((Random, ~Selected[Ids], Cells))
+    SortedCells = Cells[Order]
+    Rank = np.empty(len(Ids), dtype=np.int64)
+    Rank[Order] = np.arange(len(Ids)) - np.searchsorted(SortedCells, SortedCells)
+    Quota = int(np.ceil(Fraction * len(Ids)))
+    Selected[Ids[np.lexsort((Random, ~Selected[Ids], Rank))[:Quota]]] = True
+  return Selected
+
+#==============================================================================================================================================================
+# Camera partitioning
+#==============================================================================================================================================================
+def orderCamerasByCoVisibility(CoVisibility):
+  # Greedy chain through the cameras, each next camera sees most points together with the previous one.
+  # Starts at the camera with the least co-visible points (an end of linear rigs), CoVisibility: (N,N) counts
+  NumCams = len(CoVisibility)
+  Order = [int(np.argmin(CoVisibility.sum(axis=1)))]
+  Unvisited = np.ones(NumCams, dtype=bool)
+  Unvisited[Order[0]] = False
+  while Unvisited.any():
+    Score = np.where(Unvisited, CoVisibility[Order[-1]], -1)
+    if Score.max() <= 0: Score = np.where(Unvisited, CoVisibility[Order].sum(axis=0), -1)
+    Order.append(int(np.argmax(Score)))
+    Unvisited[Order[-1]] = False
+  return np.array(Order)
+
+def partitionCameras(CoVisibility, ClusterSize, Overlap):
+  # Overlapping clusters of ClusterSize consecutive cameras of orderCamerasByCoVisibility,
+  # consecutive clusters share Overlap cameras
+  NumCams = len(CoVisibility)
+  Order = orderCamerasByCoVisibility(CoVisibility)
+  if ClusterSize >= NumCams: return [np.sort(Order)]
+  Step = max(ClusterSize - Overlap, 1)
+  Starts = list(range(0, NumCams - ClusterSize, Step)) + [NumCams - ClusterSize]
+  return [np.sort(Order[Start:Start+ClusterSize]) for Start in Starts]
+
+def calcSimilarityTransform(RotationMs, Positions, RefRotationMs, RefPositions):
+  # Similarity transform X' = Scale * Q * X + T of world points mapping cameras (world to camera rotations RotationMs,
+  # centres Positions) onto the reference ones, rotation R' = R * Q^T and centre c' = Scale * Q * c + T of every camera
+  U, _, Vt = np.linalg.svd(np.einsum('nji,njk->ik', RefRotationMs, RotationMs))
+  Q = U @ np.diag([1.0, 1.0, np.linalg.det(U @ Vt)]) @ Vt
+  Centred = (Positions - Positions.mean(axis=0)) @ Q.T
+  RefCentred = RefPositions - RefPositions.mean(axis=0)
+  Scale = np.sum(RefCentred * Centred) / np.sum(Centred * Centred) if np.sum(Centred * Centred) > 0 else 1.0
+  T = RefPositions.mean(axis=0) - Scale * Q @ Positions.mean(axis=0)
+  return Q, Scale, T
+
+def calcProjectionBivectors(P):
+  # P: (N,3,4) or (N,4,4) projection matrices -> (N,3,6) bivectors of the row pairs skipping row 0, 1 and 2
+  Rows0 = P[:, _SKIPPED_ROWS[:,0], :]
+  Rows1 = P[:, _SKIPPED_ROWS[:,1], :]
+  return Rows0[:,:,_PLUECKER_IDX[:,0]]*Rows1[:,:,_PLUECKER_IDX[:,1]] - Rows0[:,:,_PLUECKER_IDX[:,1]]*Rows1[:,:,_PLUECKER_IDX[:,0]]
+
+def calcFundamentalMatrices(P, Pairs, Out=None):
+  # Fundamental matrices of all Pairs at once, F[k] of cameras A = P[Pairs[k,1]] and B = P[Pairs[k,0]],
+  # written into Out (M,3,3) if given
+  L = calcProjectionBivectors(P)
+  LD = np.matmul(L, _PLUECKER_DUAL)
+  if Out is None: return _COFACTOR_SIGN * np.einsum('kru,kcu->krc', LD[Pairs[:,0]], L[Pairs[:,1]])
+  np.einsum('kru,kcu->krc', LD[Pairs[:,0]], L[Pairs[:,1]], out=Out)
+  Out *= _COFACTOR_SIGN
+  return Out
+
+def calcFundamentalMatricesDers(P, Pairs, dF, Out=None):
+  # Propagates d(error)/dF of all Pairs through calcFundamentalMatrices into d(error)/dP of shape (N,3,4),
+  # written into Out (N,3,4) if given
+  L = calcProjectionBivectors(P)
+  dFS = _COFACTOR_SIGN * dF
+  dLi = np.einsum('krc,kcu->kru', dFS, np.matmul(L[Pairs[:,1]], _PLUECKER_DUAL))
+  dLj = np.einsum('krc,kru->kcu', dFS, np.matmul(L[Pairs[:,0]], _PLUECKER_DUAL))
+
+  dL = np.zeros(L.shape)
+  np.add.at(dL, Pairs[:,0], dLi)
+  np.add.at(dL, Pairs[:,1], dLj)
+
+  # L = Rows0[p]*Rows1[q] - Rows0[q]*Rows1[p]
+  Rows0 = P[:, _SKIPPED_ROWS[:,0], :]
+  Rows1 = P[:, _SKIPPED_ROWS[:,1], :]
+  dRows0 = np.zeros(Rows0.shape)
+  dRows1 = np.zeros(Rows1.shape)
+  for u, (p, q) in enumerate(_PLUECKER_IDX):
+    dRows0[:,:,p] += dL[:,:,u]*Rows1[:,:,q]
+    dRows0[:,:,q] -= dL[:,:,u]*Rows1[:,:,p]
+    dRows1[:,:,q] += dL[:,:,u]*Rows0[:,:,p]
+    dRows1[:,:,p] -= dL[:,:,u]*Rows0[:,:,q]
+
+  dP = np.zeros((P.shape[0], 3, 4)) if Out is None else Out
+  dP[:] = 0
+  for r, (r0, r1) in enumerate(_SKIPPED_ROWS):
+    dP[:,r0,:] += dRows0[:,r,:]
+    dP[:,r1,:] += dRows1[:,r,:]
+  return dP
+
+def calcFundamentalMatricesJacobian(P, Pairs):
+  # Per-pair Jacobians dF[k]/dP[Pairs[k,0]] and dF[k]/dP[Pairs[k,1]], both of shape (M,3,3,3,4)
+  NumPairs = Pairs.shape[0]
+  PairP = np.concatenate([P[Pairs[:,0],0:3,:], P[Pairs[:,1],0:3,:]])
+  PairIds = np.stack([np.arange(NumPairs), NumPairs + np.arange(NumPairs)], axis=1)
+
+  dFdPi = np.zeros((NumPairs,3,3,3,4))
+  dFdPj = np.zeros((NumPairs,3,3,3,4))
+  for r in range(3):
+    for c in range(3):
+      dF = np.zeros((NumPairs,3,3))
+      dF[:,r,c] = 1
+      dP = calcFundamentalMatricesDers(PairP, PairIds, dF)
+      dFdPi[:,r,c] = dP[:NumPairs]
+      dFdPj[:,r,c] = dP[NumPairs:]
+  return dFdPi, dFdPj
+
+#==============================================================================================================================================================
+# All-pairs epipolar errors
+#==============================================================================================================================================================
+EPIPOLAR_BACKENDS = ['auto', 'numba', 'numpy', 'threads']
+
+# Threads of the numba kernels and of the threads backend, see setNumThreads
+_Threads = {'NumThreads': 0, 'Executor': None}
+
+# Robust losses rho(z) of scipy.optimize.least_squares, applied to z = (d/c)^2 of distances d with scale c.
+# The scalar objective sums (c/2)*rho(z) per point, so huber keeps the linear tail of the plain distance.
+ROBUST_LOSSES = ['none', 'huber', 'soft_l1', 'cauchy']
+
+# Upper bound of co-visible points processed at once by the numpy backend
+_NUMPY_BLOCK_SIZE = 1 << 18
+
+def calcRobustLoss(z, Loss):
+  # rho(z), rho'(z) and rho''(z) of a robust loss
+  if Loss == 'huber':
+    Inlier = z <= 1
+    SqrtZ = np.sqrt(np.maximum(z, 1))
+    return np.where(Inlier, z, 2*SqrtZ - 1), np.where(Inlier, 1.0, 1/SqrtZ), np.where(Inlier, 0.0, -0.5/(SqrtZ*SqrtZ*SqrtZ))
+  if Loss == 'soft_l1':
+    T = 1 + z
+    return 2*(np.sqrt(T) - 1), 1/np.sqrt(T), -0.5/(T*np.sqrt(T))
+  if Loss == 'cauchy':
+    T = 1 + z
+    return np.log(T), 1/T, -1/(T*T)
+  if Loss == 'none':
+    return z, np.ones_like(z), np.zeros_like(z)
+  raise ValueError(f'Unknown robust loss {Loss}')
+
+def buildCoVisibilityIndex(Visibility, NumPoints, Pairs):
+  # Visibility: (N,ceil(P/8)) bitsets (np.packbits) of points visible in each camera
+  # Returns CSR index of points visible in both cameras of each pair: PairPtr (M+1,) and PairPointIds (nnz,)
+  PointIds = [np.flatnonzero(np.unpackbits(Visibility[i] & Visibility[j], count=NumPoints)).astype(np.int32) for i, j in Pairs]
+  PairPtr = np.zeros(len(Pairs)+1, dtype=np.int64)
+  PairPtr[1:] = np.cumsum([len(Ids) for Ids in PointIds])
+  PairPointIds = np.concatenate(PointIds) if len(PointIds) > 0 else np.zeros(0, dtype=np.int32)
+  return PairPtr, PairPointIds
+
+def calcEpipolarErrors(XY, F, Pairs, PairPtr, PairPointIds, Ders=False, Backend='auto', Loss='none', LossScale=1.0, Out=None, Scratch=None):
+  # Distances between the points of camera i and the epipolar lines of the points of camera j for all Pairs (i, j)
+  # XY: (N,P,2) reference point coordinates of all cameras
+  # F:  (M,3,3) fundamental matrices as returned by calcFundamentalMatrices
+  # PairPtr, PairPointIds: co-visible points of each pair, see buildCoVisibilityIndex (PairPtr may be a slice)
+  # Returns per-pair mean errors (M,) under the robust Loss, distances of the co-visible points (PairPtr[-1]-PairPtr[0],)
+  # and, if Ders, the derivatives of the per-pair means over F (M,3,3)
+  # Out: optional (pair_err, point_err, dF) buffers of these shapes the results are written into
+  # Scratch: optional block buffers of the numpy backend, see allocNumpyScratch
+  if Out is None: Out = (np.zeros(Pairs.shape[0]), np.zeros(PairPtr[-1] - PairPtr[0]), np.zeros((Pairs.shape[0], 3, 3)))
+  Backend = resolveBackend(Backend)
+  if Backend == 'numba':
+    if not NUMBA_AVAILABLE: raise RuntimeError('Numba backend requested, but numba is not installed')
+    return _calcEpipolarErrorsNumba(XY, F, Pairs, PairPtr, PairPointIds, Ders, ROBUST_LOSSES.index(Loss), LossScale, *Out)
+  if Backend == 'numpy':
+    if Scratch is None: Scratch = allocNumpyScratch(PairPtr[-1] - PairPtr[0])
+    return _calcEpipolarErrorsNumpy(XY, F, Pairs, PairPtr, PairPointIds, Ders, Loss, LossScale, *Out, Scratch)
+  if Backend == 'threads':
+    if not NUMBA_AVAILABLE: raise RuntimeError('Threads backend requested, but numba is not installed')
+    return _calcEpipolarErrorsThreads(XY, F, Pairs, PairPtr, PairPointIds, Ders, ROBUST_LOSSES.index(Loss), LossScale, *Out)
+  raise ValueError(f'Unknown epipolar errors backend {Backend}')
+
+def resolveBackend(Backend):
+  # Backend run by calcEpipolarErrors for the requested one
+  if Backend == 'auto': return 'numba' if NUMBA_AVAILABLE else 'numpy'
+  return Backend
+
+def setNumThreads(NumThreads):
+  # Number of threads of the numba kernels (prange over pairs) and of the threads backend, 0 uses all cores.
+  # Returns the number of threads
+  if NumThreads <= 0: NumThreads = numba.config.NUMBA_NUM_THREADS if NUMBA_AVAILABLE else os.cpu_count()
+  if NUMBA_AVAILABLE: numba.set_num_threads(min(NumThreads, numba.config.NUMBA_NUM_THREADS))
+  if _Threads['NumThreads'] != NumThreads and _Threads['Executor'] is not None:
+    _Threads['Executor'].shutdown()
+    _Threads['Executor'] = None
+  _Threads['NumThreads'] = NumThreads
+  return NumThreads
+
+def _calcEpipolarErrorsThreads(XY, F, Pairs, PairPtr, PairPointIds, Ders, LossId, LossScale, pair_err, point_err, dF):
+  # Contiguous blocks of pairs with similar numbers of co-visible points evaluated by a pool of threads running the
+  # serial nogil kernel writing into its slices of the outputs. Every pair is summed by one thread in the serial
+  # order, so results equal those of the serial kernel bit-for-bit for any number of threads
+  if _Threads['NumThreads'] <= 0: _Threads['NumThreads'] = numba.get_num_threads()
+  if _Threads['Executor'] is None: _Threads['Executor'] = ThreadPoolExecutor(_Threads['NumThreads'])
+  NumPairs = Pairs.shape[0]
+  Targets = np.linspace(PairPtr[0], PairPtr[NumPairs], _Threads['NumThreads'] + 1)[1:-1]
+  Bounds = np.unique(np.concatenate([[0], np.searchsorted(PairPtr[:NumPairs], Targets), [NumPairs]]))
+
+  Base = PairPtr[0]
+  Futures = [_Threads['Executor'].submit(_calcEpipolarErrorsNogil, XY, F[B0:B1], Pairs[B0:B1], PairPtr[B0:B1+1], PairPointIds, Ders, LossId, LossScale, \
+    pair_err[B0:B1], point_err[PairPtr[B0]-Base:PairPtr[B1]-Base], dF[B0:B1]) for B0, B1 in zip(Bounds[:-1], Bounds[1:])]
+  for Future in Futures: Future.result()
+  return pair_err, point_err, dF
+
+@my_jit(nopython=True, cache=True)
+def _robustLossNumba(d, LossId, LossScale):
+  # (c/2)*rho((d/c)^2) and its derivative over d, LossId indexes ROBUST_LOSSES
+  if LossId == 0: return d, 1.0
+  z = (d/LossScale)*(d/LossScale)
+  if LossId == 1:
+    if z <= 1: return 0.5*LossScale*z, d/LossScale
+    return 0.5*LossScale*(2*np.sqrt(z) - 1), 1.0
+  if LossId == 2:
+    return LossScale*(np.sqrt(1 + z) - 1), d/(LossScale*np.sqrt(1 + z))
+  return 0.5*LossScale*np.log(1 + z), d/(LossScale*(1 + z))
+
+@my_jit(nopython=True, cache=True)
+def _calcPairEpipolarErrorsNumba(XY, F, Pairs, PairPtr, PairPointIds, Ders, LossId, LossScale, k, Base, pair_err, point_err, dF):
+  # Errors of pair k, shared by the parallel and the serial kernel so that both compute the same bits
+  i = Pairs[k,0]
+  j = Pairs[k,1]
+  error = 0.0
+  pair_err[k] = 0.0
+  dF[k,:,:] = 0.0
+  numofpoints = PairPtr[k+1] - PairPtr[k]
+  for idx in range(PairPtr[k], PairPtr[k+1]):
+    n = PairPointIds[idx]
+    x0 = np.float64(XY[j,n,0])
+    y0 = np.float64(XY[j,n,1])
+    x1 = np.float64(XY[i,n,0])
+    y1 = np.float64(XY[i,n,1])
+    # l0 = F . m0, e = m1 . l0
+    l00 = F[k,0,0]*x0 + F[k,0,1]*y0 + F[k,0,2]
+    l01 = F[k,1,0]*x0 + F[k,1,1]*y0 + F[k,1,2]
+    l02 = F[k,2,0]*x0 + F[k,2,1]*y0 + F[k,2,2]
+    e = x1*l00 + y1*l01 + l02
+    s = np.sqrt(l00*l00 + l01*l01)
+    d = abs(e)/s
+    point_err[idx - Base] = d
+    rho, drho = _robustLossNumba(d, LossId, LossScale)
+    error += rho
+
+    if Ders:
+      # d(rho(|e|/s))/dF = g . m0^T
+      g0 = drho*(np.sign(e)/s*x1 - abs(e)*l00/(s*s*s))
+      g1 = drho*(np.sign(e)/s*y1 - abs(e)*l01/(s*s*s))
+      g2 = drho*(np.sign(e)/s)
+      dF[k,0,0] += g0*x0
+      dF[k,0,1] += g0*y0
+      dF[k,0,2] += g0
+      dF[k,1,0] += g1*x0
+      dF[k,1,1] += g1*y0
+      dF[k,1,2] += g1
+      dF[k,2,0] += g2*x0
+      dF[k,2,1] += g2*y0
+      dF[k,2,2] += g2
+
+  if numofpoints > 0:
+    pair_err[k] = error/numofpoints
+    for r in range(3):
+      for c in range(3):
+        dF[k,r,c] /= numofpoints
+
+@my_jit(nopython=True, parallel=True, cache=True)
+def _calcEpipolarErrorsNumba(XY, F, Pairs, PairPtr, PairPointIds, Ders, LossId, LossScale, pair_err, point_err, dF):
+  NumPairs = Pairs.shape[0]
+  Base = PairPtr[0]
+
+  for k in my_prange(NumPairs):
+    _calcPairEpipolarErrorsNumba(XY, F, Pairs, PairPtr, PairPointIds, Ders, LossId, LossScale, k, Base, pair_err, point_err, dF)
+
+  return pair_err, point_err, dF
+
+@my_jit(nopython=True, nogil=True, cache=True)
+def _calcEpipolarErrorsNogil(XY, F, Pairs, PairPtr, PairPointIds, Ders, LossId, LossScale, pair_err, point_err, dF):
+  # Serial kernel releasing the GIL for the threads backend
+  NumPairs = Pairs.shape[0]
+  Base = PairPtr[0]
+
+  for k in range(NumPairs):
+    _calcPairEpipolarErrorsNumba(XY, F, Pairs, PairPtr, PairPointIds, Ders, LossId, LossScale, k, Base, pair_err, point_err, dF)
+
+  return pair_err, point_err, dF
+
+def allocNumpyScratch(NumEntries):
+  # Buffers of one block of co-visible points of the numpy backend, blocks hold up to NumEntries points
+  B = max(1, min(int(NumEntries), _NUMPY_BLOCK_SIZE))
+  Scratch = {'K': np.zeros(B, dtype=np.intp), 'Cams': np.zeros((B,2), dtype=np.intp), 'Rows': np.zeros(B, dtype=np.intp), \
+    'XY': np.zeros((B,2), dtype=np.float32), 'm0': np.ones((B,3)), 'm1': np.ones((B,3)), 'FK': np.zeros((B,9)), 'l0': np.zeros((B,3)), \
+    'g': np.zeros((B,3)), 'Mask': np.zeros(B, dtype=bool)}
+  for Name in ['e', 's', 't', 'a', 'c', 'rho', 'drho']: Scratch[Name] = np.zeros(B)
+  return Scratch
+
+def _pointRows(XY):
+  # (R,2) view of XY (N,P,2) with XY[i,n] in row i*CamStride + n, so that points of many cameras are gathered by np.take
+  S0, S1, S2 = XY.strides
+  if XY.shape[0] == 0 or S1 <= 0 or S0 < 0 or S0 % S1 != 0: return None, 0
+  CamStride = S0 // S1
+  return np.lib.stride_tricks.as_strided(XY, shape=((XY.shape[0]-1)*CamStride + XY.shape[1], 2), strides=(S1, S2)), CamStride
+
+def _robustLossInPlace(t, Loss, LossScale, rho, drho, Mask):
+  # (c/2)*rho((d/c)^2) and its derivative over d of t = d/c, written into rho and drho
+  c = LossScale
+  if Loss == 'huber':
+    np.greater(t, 1, out=Mask)
+    np.multiply(t, t, out=rho)
+    rho *= 0.5*c
+    np.multiply(t, c, out=drho)
+    drho -= 0.5*c
+    np.copyto(rho, drho, where=Mask)
+    np.copyto(drho, t)
+    np.copyto(drho, 1.0, where=Mask)
+  elif Loss == 'soft_l1':
+    np.multiply(t, t, out=drho)
+    drho += 1
+    np.sqrt(drho, out=drho)
+    np.subtract(drho, 1, out=rho)
+    rho *= c
+    np.divide(t, drho, out=drho)
+  elif Loss == 'cauchy':
+    np.multiply(t, t, out=drho)
+    drho += 1
+    np.log(drho, out=rho)
+    rho *= 0.5*c
+    np.divide(t, drho, out=drho)
+  else:
+    raise ValueError(f'Unknown robust loss {Loss}')
+
+def _calcEpipolarErrorsNumpy(XY, F, Pairs, PairPtr, PairPointIds, Ders, Loss, LossScale, pair_err, point_err, dF, Scratch):
+  # Blocks of co-visible points evaluated by ufuncs writing into the Scratch buffers, nothing is allocated per point
+  NumPairs = Pairs.shape[0]
+  Base = PairPtr[0]
+  NumEntries = PairPtr[NumPairs] - Base
+  pair_err[:] = 0
+  dF[:] = 0
+  NumOfPoints = np.diff(PairPtr)
+  Rows, CamStride = _pointRows(XY) if XY.dtype == Scratch['XY'].dtype else (None, 0)
+  if Pairs.dtype != Scratch['Cams'].dtype: Pairs = Pairs.astype(Scratch['Cams'].dtype)
+  F9 = F.reshape(-1, 9)
+  BlockSize = len(Scratch['K'])
+
+  k = 0
+  for b in range(0, NumEntries, BlockSize):
+    L = min(BlockSize, NumEntries - b)
+    S = {Name: Buffer[:L] for Name, Buffer in Scratch.items()}
+    K, m0, m1, l0, e, s, t, g = S['K'], S['m0'], S['m1'], S['l0'], S['e'], S['s'], S['t'], S['g']
+    n = PairPointIds[Base+b:Base+b+L]
+
+    # Pair of every point of the block
+    while PairPtr[k+1] - Base <= b: k += 1
+    while k < NumPairs and PairPtr[k] - Base < b + L:
+      K[max(PairPtr[k] - Base - b, 0):min(PairPtr[k+1] - Base - b, L)] = k
+      k += 1
+    k -= 1
+
+    # m1 = [XY[i,n], 1], m0 = [XY[j,n], 1] of pairs (i, j)
+    np.take(Pairs, K, axis=0, out=S['Cams'], mode='clip')
+    for m, side in [(m1, 0), (m0, 1)]:
+      if Rows is None:
+        m[:,0:2] = XY[S['Cams'][:,side], n]
+        continue
+      np.multiply(S['Cams'][:,side], CamStride, out=S['Rows'])
+      np.add(S['Rows'], n, out=S['Rows'])
+      np.take(Rows, S['Rows'], axis=0, out=S['XY'], mode='clip')
+      np.copyto(m[:,0:2], S['XY'])
+
+    # l0 = F . m0, e = m1 . l0, d = |e|/|l0[0:2]|
+    np.take(F9, K, axis=0, out=S['FK'], mode='clip')
+    for r in range(3):
+      np.multiply(S['FK'][:,3*r], m0[:,0], out=l0[:,r])
+      np.multiply(S['FK'][:,3*r+1], m0[:,1], out=t)
+      np.add(l0[:,r], t, out=l0[:,r])
+      np.add(l0[:,r], S['FK'][:,3*r+2], out=l0[:,r])
+    np.multiply(m1[:,0], l0[:,0], out=e)
+    np.multiply(m1[:,1], l0[:,1], out=t)
+    np.add(e, t, out=e)
+    np.add(e, l0[:,2], out=e)
+    np.multiply(l0[:,0], l0[:,0], out=s)
+    np.multiply(l0[:,1], l0[:,1], out=t)
+    np.add(s, t, out=s)
+    np.sqrt(s, out=s)
+    d = point_err[b:b+L]
+    np.abs(e, out=d)
+    np.divide(d, s, out=d)
+
+    if Loss == 'none':
+      rho, drho = d, None
+    else:
+      rho, drho = S['rho'], S['drho']
+      np.divide(d, LossScale, out=t)
+      _robustLossInPlace(t, Loss, LossScale, rho, drho, S['Mask'])
+    np.add.at(pair_err, K, rho)
+
+    if Ders:
+      # d(rho(|e|/s))/dF = g . m0^T, g = drho*(sign(e)/s*m1 - |e|/s^3*[l0[0:2], 0])
+      a, c = S['a'], S['c']
+      np.sign(e, out=a)
+      np.divide(a, s, out=a)
+      np.divide(d, s, out=c)
+      np.divide(c, s, out=c)
+      if drho is not None:
+        np.multiply(a, drho, out=a)
+        np.multiply(c, drho, out=c)
+      for r in range(3):
+        np.multiply(m1[:,r], a, out=g[:,r])
+        if r < 2:
+          np.multiply(l0[:,r], c, out=t)
+          np.subtract(g[:,r], t, out=g[:,r])
+        for col in range(3):
+          np.multiply(g[:,r], m0[:,col], out=t)
+          np.add.at(dF[:,r,col], K, t)
+
+  Scale = 1.0/np.maximum(NumOfPoints, 1)
+  pair_err *= Scale
+  dF *= Scale[:,None,None]
+  return pair_err, point_err, dF
+
+def warmupKernels():
+  # Compiles the numba kernels for the argument types used by Calibrator, or loads them from the on-disk cache.
+  # Returns seconds spent and whether the kernel came from the cache, for each kernel
+  Times = {}
+  if not NUMBA_AVAILABLE: return Times
+  Rng = np.random.default_rng(0)
+  XY = Rng.uniform(0, 100, (2,8,2)).astype(np.float32)
+  F = np.array([[[0.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 1.0, 0.0]]])
+  Pairs = getCameraPairs(2)
+
+  Out = (np.zeros(1), np.zeros(8), np.zeros((1,3,3)))
+  for Kernel, Args in [(_calcEpipolarErrorsNumba, (XY, F, Pairs, np.array([0, 8]), np.arange(8, dtype=np.int32), True, 0, 1.0, *Out)), \
+                       (_calcEpipolarErrorsNogil, (XY, F, Pairs, np.array([0, 8]), np.arange(8, dtype=np.int32), True, 0, 1.0, *Out))]:
+    Start = time.perf_counter()
+    Kernel(*Args)
+    Times[Kernel.__name__] = (time.perf_counter() - Start, sum(Kernel.stats.cache_hits.values()) > 0)
+  return Times
+
+def calcEpipolarResiduals(m1, F, m0, PairIds, Ders=False):
+  # Signed distances between points m1 (R,3) and epipolar lines of points m0 (R,3) through F[PairIds] (M,3,3)
+  # Returns residuals (R,) and, if Ders, their derivatives over F[PairIds] (R,3,3)
+  l0 = np.einsum('nrc,nc->nr', F[PairIds], m0)
+  e = np.einsum('nr,nr->n', m1, l0)
+  s = np.sqrt(l0[:,0]*l0[:,0] + l0[:,1]*l0[:,1])
+  r = e/s
+  if not Ders: return r, None
+
+  g = m1/s[:,None]
+  g[:,0:2] -= (e/(s*s*s))[:,None]*l0[:,0:2]
+  return r, np.einsum('nr,nc->nrc', g, m0)
+
+#==============================================================================================================================================================
+# Triangulation and reprojection errors
+#==============================================================================================================================================================
+def calcReprojectionErrors(P, XY, Visible, PointIds, Ders=False, Loss='none', LossScale=1.0):
+  # Triangulates the PointIds by linear multi-view DLT over their visible cameras and reprojects them to all of them
+  # P: (N,3,4) or (N,4,4) projection matrices, XY: (N,P,2) reference point coordinates, Visible: (N,P) bool
+  # Returns per-camera mean reprojection errors (N,) under the robust Loss, reprojection distances (N,len(PointIds))
+  # (NaN where not visible), triangulated points (len(PointIds),3) and, if Ders, the derivatives of the mean of
+  # the per-camera errors over P (N,3,4), including the dependence of the triangulated points on P
+  NumCams = P.shape[0]
+  P = P[:,0:3,:]
+  NumOfPoints = np.sum(Visible[:,PointIds], axis=1)
+  CamScale = 1.0/(NumCams*np.maximum(NumOfPoints, 1))
+  cam_err = np.zeros(NumCams)
+  point_err = np.full((NumCams, len(PointIds)), np.nan)
+  X = np.zeros((len(PointIds), 3))
+  dP = np.zeros((NumCams, 3, 4))
+
+  BlockSize = max(_NUMPY_BLOCK_SIZE // NumCams, 1)
+  for b in range(0, len(PointIds), BlockSize):
+    Ids = PointIds[b:b+BlockSize]
+    xy = XY[:,Ids].astype(np.float64)
+    W = Visible[:,Ids].astype(np.float64)
+
+    # Rows x*P2 - P0 and y*P2 - P1 of the DLT, solved inhomogeneously: sum(As As^T) X = -sum(As A3)
+    A = xy[:,:,:,None]*P[:,None,None,2,:] - P[:,None,0:2,:]
+    As = A[...,0:3]
+    WAs = As*W[:,:,None,None]
+    M = np.einsum('nbkr,nbks->brs', WAs, As)
+    Xb = np.linalg.solve(M, -np.einsum('nbkr,nbk->br', WAs, A[...,3])[:,:,None])[:,:,0]
+    Xh = np.concatenate([Xb, np.ones((len(Ids), 1))], axis=1)
+    X[b:b+len(Ids)] = Xb
+
+    Proj = np.einsum('nrc,bc->nbr', P, Xh)
+    u = Proj[:,:,0:2]/Proj[:,:,2:3]
+    Diff = u - xy
+    d = np.sqrt(np.sum(Diff*Diff, axis=2))
+    point_err[:,b:b+len(Ids)] = np.where(W > 0, d, np.nan)
+
+    if Loss == 'none':
+      rho, drho = d, np.ones_like(d)
+    else:
+      rho, drho, _ = calcRobustLoss((d/LossScale)**2, Loss)
+      rho, drho = 0.5*LossScale*rho, drho*d/LossScale
+    cam_err += np.sum(rho*W, axis=1)
+
+    if Ders:
+      # Direct dependence of the reprojections on P
+      gu = (W*drho*CamScale[:,None]/np.maximum(d, np.finfo(np.float64).tiny))[:,:,None]*Diff/Proj[:,:,2:3]
+      gw = np.sum(gu*u, axis=2)
+      dP[:,0:2,:] += np.einsum('nbk,bc->nkc', gu, Xh)
+      dP[:,2,:] -= np.einsum('nb,bc->nc', gw, Xh)
+
+      # Dependence through the triangulated points, by the adjoint L = M^-1 dE/dX of the normal equations
+      gX = np.einsum('nbk,nkr->br', gu, P[:,0:2,0:3]) - np.einsum('nb,nr->br', gw, P[:,2,0:3])
+      L = np.linalg.solve(M, gX[:,:,None])[:,:,0]
+      r = np.einsum('nbkc,bc->nbk', A, Xh)
+      dA = -W[:,:,None,None]*(r[...,None]*np.concatenate([L, np.zeros((len(Ids), 1))], axis=1)[None,:,None,:] \
+        + np.einsum('nbkr,br->nbk', As, L)[...,None]*Xh[None,:,None,:])
+      dP[:,2,:] += np.einsum('nbk,nbkc->nc', xy, dA)
+      dP[:,0:2,:] -= np.sum(dA, axis=1)
+
+  return cam_err/np.maximum(NumOfPoints, 1), point_err, X, dP
+
+#==============================================================================================================================================================
+# Derivatives
+#==============================================================================================================================================================
+def calcRotationMatrices(RotationQs):
+  # Rotation matrices (N,3,3) of (not necessarily unit) scalar-last quaternions (N,4), as in Rotation.from_quat
+  U = RotationQs/np.linalg.norm(RotationQs, axis=1)[:,None]
+  x, y, z, w = U[:,0], U[:,1], U[:,2], U[:,3]
+
+  RotationMs = np.empty((len(U),3,3))
+  RotationMs[:,0,0], RotationMs[:,0,1], RotationMs[:,0,2] = 1-2*(y*y+z*z),   2*(x*y-z*w),   2*(x*z+y*w)
+  RotationMs[:,1,0], RotationMs[:,1,1], RotationMs[:,1,2] =   2*(x*y+z*w), 1-2*(x*x+z*z),   2*(y*z-x*w)
+  RotationMs[:,2,0], RotationMs[:,2,1], RotationMs[:,2,2] =   2*(x*z-y*w),   2*(y*z+x*w), 1-2*(x*x+y*y)
+  return RotationMs
+
+def calcRotationMatricesDers(RotationQs):
+  # Rotation matrices (N,3,3) of quaternions (N,4) together with dR/dQ of shape (N,4,3,3)
+  Norm = np.linalg.norm(RotationQs, axis=1)
+  U = RotationQs/Norm[:,None]
+  x, y, z, w = U[:,0], U[:,1], U[:,2], U[:,3]
+  o = np.zeros(len(U))
+
+  # Derivatives over the normalized quaternion
+  dRdU = 2*np.stack([
+    np.stack([np.stack([    o,    y,    z], -1), np.stack([ y, -2*x, -w], -1), np.stack([ z,  w, -2*x], -1)], -2),
+    np.stack([np.stack([-2*y,    x,    w], -1), np.stack([ x,    o,  z], -1), np.stack([-w,  z, -2*y], -1)], -2),
+    np.stack([np.stack([-2*z,   -w,    x], -1), np.stack([ w, -2*z,  y], -1), np.stack([ x,  y,    o], -1)], -2),
+    np.stack([np.stack([    o,   -z,    y], -1), np.stack([ z,    o, -x], -1), np.stack([-y,  x,    o], -1)], -2)], 1)
+
+  # Chain through normalization U = Q/|Q|
+  dUdQ = (np.eye(4)[None] - U[:,:,None]*U[:,None,:])/Norm[:,None,None]
+  dRdQ = np.einsum('nqu,nuab->nqab', dUdQ, dRdU)
+
+  return calcRotationMatrices(RotationQs), dRdQ
+
+def calcProjectionMatrices(K, OptimParam):
+  # Projection matrices P = K*[R | -R*t] of all cameras (N,4,4) from the params [Q, t] of each camera
+  Params = np.reshape(np.asarray(OptimParam, dtype=np.float64), (-1,7))
+  P = np.zeros((len(Params),4,4))
+  P[:,0:3,0:3] = np.matmul(K[:,0:3,0:3], calcRotationMatrices(Params[:,0:4]))
+  P[:,0:3,3]   = -1 * np.einsum('nab,nb->na', P[:,0:3,0:3], Params[:,4:7])
+  P[:,3,3]     = 1
+  return P
+
+def calcProjectionMatricesDers(K, OptimParam, Out=None):
+  # Projection matrices (N,4,4) as in calcProjectionMatrices and their derivatives over the params (N,7,3,4),
+  # written into Out (P, dPdParam) buffers of these shapes if given
+  Params = np.reshape(np.asarray(OptimParam, dtype=np.float64), (-1,7))
+  RotationMs, dRdQ = calcRotationMatricesDers(Params[:,0:4])
+  TranslationVs = Params[:,4:7]
+  KM = K[:,0:3,0:3]
+
+  P, dPdParam = (np.zeros((len(Params),4,4)), np.zeros((len(Params),7,3,4))) if Out is None else Out
+  P[:] = 0
+  np.matmul(KM, RotationMs, out=P[:,0:3,0:3])
+  np.einsum('nab,nb->na', P[:,0:3,0:3], TranslationVs, out=P[:,0:3,3])
+  np.negative(P[:,0:3,3], out=P[:,0:3,3])
+  P[:,3,3]     = 1
+
+  dPdParam[:] = 0
+  np.einsum('nab,nqbc->nqac', KM, dRdQ, out=dPdParam[:,0:4,:,0:3])
+  np.einsum('nqab,nb->nqa', dPdParam[:,0:4,:,0:3], TranslationVs, out=dPdParam[:,0:4,:,3])
+  np.negative(dPdParam[:,0:4,:,3], out=dPdParam[:,0:4,:,3])
+  np.negative(np.transpose(P[:,0:3,0:3], (0,2,1)), out=dPdParam[:,4:7,:,3])
+
+  return P, dPdParam
 
 #==============================================================================================================================================================
@@ -0,0 +1,70 @@
+import numpy as np
+
+import utils
+
+# ===================================================================================================
+# Buffers of objective evaluations
+# ===================================================================================================
+class EvaluationWorkspace(object):
+    # Output and scratch buffers of the epipolar objective owned by a Calibrator: projection matrices and their
+    # derivatives, fundamental matrices, per-pair errors, per-point errors, dF and dP are written in place by every
+    # evaluation, the numpy backend also reuses its block buffers (scratch). Buffers of points only grow, so rebuilding
+    # the co-visibility index after rejection of reference points reuses them.
+    def __init__(self, numOfParams, numOfPairs, numOfEntries, numpyScratch=False) -> None:
+        numOfCameras = numOfParams // 7
+        self.P          = np.zeros((numOfCameras, 4, 4))
+        self.dPdParam   = np.zeros((numOfCameras, 7, 3, 4))
+        self.F          = np.zeros((numOfPairs, 3, 3))
+        self.pairErrors = np.zeros(numOfPairs)
+        self.dF         = np.zeros((numOfPairs, 3, 3))
+        self.dP         = np.zeros((numOfCameras, 3, 4))
+        self.grad       = np.zeros(numOfParams)
+        self.lastParam  = np.full(numOfParams, np.nan)
+        self.scratch    = utils.allocNumpyScratch(numOfEntries) if numpyScratch else None
+        self._pointErrors = np.zeros(numOfEntries)
+        return
+
+    def fits(self, numOfParams, numOfPairs, numOfEntries, numpyScratch=False) -> bool:
+        return len(self.grad) == numOfParams and len(self.pairErrors) == numOfPairs and len(self._pointErrors) >= numOfEntries \
+            and (self.scratch is not None or not numpyScratch)
+
+    def epipolarOutputs(self, numOfEntries):
+        # (pair_err, point_err, dF) buffers of utils.calcEpipolarErrors
+        return self.pairErrors, self._pointErrors[:numOfEntries], self.dF
+
+# ===================================================================================================
+# Memo of recent evaluations
+# ===================================================================================================
+class EvaluationMemo(object):
+    # Objective values and gradients of the most recently evaluated distinct params, kept in preallocated
+    # ring buffers. Returned gradients are views of the buffers, valid until the slot is reused.
+    def __init__(self, numOfParams, size=4) -> None:
+        self._params = np.full((size, numOfParams), np.nan)
+        self._errors = np.zeros(size)
+        self._grads  = np.zeros((size, numOfParams))
+        self._hasGrad = np.zeros(size, dtype=bool)
+        self._next = 0
+        self.hits = 0
+        return
+
+    def lookup(self, optimParam, ders):
+        # (error, gradient or None) stored for exactly these params, or None
+        for slot in range(len(self._errors)):
+            if (self._hasGrad[slot] or not ders) and np.array_equal(self._params[slot], optimParam):
+                self.hits += 1
+                return self._errors[slot], self._grads[slot] if self._hasGrad[slot] else None
+        return None
+
+    def store(self, optimParam, error, grad=None) -> None:
+        slot = self._next
+        self._params[slot] = optimParam
+        self._errors[slot] = error
+        self._hasGrad[slot] = grad is not None
+        if grad is not None: self._grads[slot] = grad
+        self._next = (slot + 1) % len(self._errors)
+        return
+
+    def clear(self) -> None:
+        self._params[:] = np.nan
+        self._hasGrad[:] = False
+        return
@@ -1,6 +1,4 @@
 import pyraw_nano
-import openpyxl
-import openpyxl.utils
 import argparse
 import numpy as np
 
@@ -63,6 +61,10 @@ def main():
                 badMatchedPixels(calibParams, gtParams, threshold))
 
 
+    # openpyxl is only needed to write the results
+    import openpyxl
+    import openpyxl.utils
+
     wb = openpyxl.Workbook()
     ws = wb.create_sheet('gtRender_vs_calibParams')
     ws['A1'] = 'thresh'
@@ -1,7 +1,10 @@
 import bpy
 import os
+import sys
 from mathutils import Vector
-import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Calibrator'))
+import markers
 
 
 def project_3d_point(camera: bpy.types.Object, p: Vector, render: bpy.types.RenderSettings = bpy.context.scene.render) -> Vector:
@@ -85,8 +88,8 @@ def main():
                 frameMarker.append(1)
         markerPositionsGT.append(frameMarker)
         
-    with open(os.path.dirname(bpy.path.abspath(bpy.data.filepath)) + '\\markerPositionsGT.txt', 'w') as file:
-        np.savetxt(file, markerPositionsGT, fmt='%.3f', delimiter='\t')
+    XY, visibility = markers.markerArraysFromRows(markerPositionsGT, len(bpy.data.cameras), dtype=float)
+    markers.writeMarkerPositions(os.path.dirname(bpy.path.abspath(bpy.data.filepath)) + '\\markerPositionsGT.txt', XY, visibility)
             
     return True
 